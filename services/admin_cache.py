@@ -0,0 +1,117 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Dict, FrozenSet, Optional, Tuple
+
+
+logger = logging.getLogger(__name__)
+
+
+class AdminRosterCache:
+    """
+    每个群的管理员名单缓存：首次命中时通过管理员过滤器拉取一次名单，
+    之后按 TTL 刷新或在收到管理员变更更新时失效，判定变为内存集合查找。
+    以 LRU 限制缓存的群数量，避免账号加入上千个群时内存无限增长。
+    """
+
+    def __init__(self, ttl_seconds: int = 3600, max_chats: int = 5000, error_ttl_seconds: int = 300) -> None:
+        self.ttl_seconds = ttl_seconds
+        self.max_chats = max_chats
+        # 拉取失败（无权限等）时按空名单放行，较短时间后再重试
+        self.error_ttl_seconds = error_ttl_seconds
+        self._rosters: "OrderedDict[int, Tuple[FrozenSet[int], float]]" = OrderedDict()
+        self._inflight: Dict[int, "asyncio.Future[FrozenSet[int]]"] = {}
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.invalidations = 0
+        self.evictions = 0
+        self.errors = 0
+
+    async def is_admin(self, client: Any, chat_id: int, user_id: int) -> bool:
+        roster = await self.get_roster(client, chat_id)
+        return user_id in roster
+
+    async def get_roster(self, client: Any, chat_id: int) -> FrozenSet[int]:
+        entry = self._rosters.get(chat_id)
+        now = time.monotonic()
+        if entry is not None:
+            roster, expires_at = entry
+            if now < expires_at:
+                self.hits += 1
+                self._rosters.move_to_end(chat_id)
+                return roster
+            self.refreshes += 1
+        else:
+            self.misses += 1
+
+        # 同一群并发请求只发起一次拉取
+        pending = self._inflight.get(chat_id)
+        if pending is not None:
+            return await pending
+        fut: "asyncio.Future[FrozenSet[int]]" = asyncio.get_running_loop().create_future()
+        self._inflight[chat_id] = fut
+        try:
+            roster, ttl = await self._fetch(client, chat_id)
+            self._store(chat_id, roster, ttl)
+            fut.set_result(roster)
+            return roster
+        except BaseException as e:
+            fut.set_exception(e)
+            # 避免无人等待时出现 "exception was never retrieved"
+            fut.exception()
+            raise
+        finally:
+            self._inflight.pop(chat_id, None)
+
+    async def _fetch(self, client: Any, chat_id: int) -> Tuple[FrozenSet[int], int]:
+        from telethon.tl.types import (
+            ChannelParticipantsAdmins,
+            ChannelParticipantAdmin,
+            ChannelParticipantCreator,
+            ChatParticipantAdmin,
+            ChatParticipantCreator,
+        )
+
+        admin_types = (ChannelParticipantAdmin, ChannelParticipantCreator, ChatParticipantAdmin, ChatParticipantCreator)
+        ids = set()
+        try:
+            async for user in client.iter_participants(chat_id, filter=ChannelParticipantsAdmins):
+                participant = getattr(user, "participant", None)
+                if participant is None or isinstance(participant, admin_types):
+                    ids.add(int(user.id))
+        except Exception as e:
+            self.errors += 1
+            logger.debug("拉取管理员名单失败 %s：%s", chat_id, e)
+            return frozenset(), self.error_ttl_seconds
+        return frozenset(ids), self.ttl_seconds
+
+    def _store(self, chat_id: int, roster: FrozenSet[int], ttl: int) -> None:
+        self._rosters[chat_id] = (roster, time.monotonic() + ttl)
+        self._rosters.move_to_end(chat_id)
+        while len(self._rosters) > self.max_chats:
+            self._rosters.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, chat_id: Optional[int]) -> None:
+        if chat_id is None:
+            return
+        if self._rosters.pop(chat_id, None) is not None:
+            self.invalidations += 1
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses + self.refreshes
+        return {
+            "size": len(self._rosters),
+            "max_chats": self.max_chats,
+            "hits": self.hits,
+            "misses": self.misses,
+            "refreshes": self.refreshes,
+            "invalidations": self.invalidations,
+            "evictions": self.evictions,
+            "errors": self.errors,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
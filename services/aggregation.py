@@ -0,0 +1,97 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import Any, Optional
+
+from .filters import MatchResult
+
+
+# 聚合窗口：首次命中后 10 分钟发送，键保留 12 分钟
+AGG_WINDOW_SECONDS = 600
+AGG_KEY_TTL_SECONDS = 12 * 60
+
+# 聚合键前缀；到期索引故意不使用该前缀，避免被 wd:agg:* 匹配
+AGG_PREFIX = "wd:agg:"
+# 到期索引：有序集合，成员为聚合键，分值为 finalize_at
+AGG_DUE_KEY = "wd:due:agg"
+
+
+# 单次往返完成聚合写入：
+# - 键不存在：写入全部字段并设置 TTL，同时以 finalize_at 登记到期索引；
+# - 键已存在：金额更大才替换关键词/金额；hit_at_ts 取最早；finalize_at 永不延长。
+# 返回 {是否新建, 当前金额, 当前 hit_at_ts, finalize_at}
+AGG_UPSERT_LUA = """
+local key = KEYS[1]
+local amount = tonumber(ARGV[4])
+local now_ts = tonumber(ARGV[8])
+if redis.call('EXISTS', key) == 0 then
+  redis.call('HSET', key,
+    'username', ARGV[1], 'user_id', ARGV[2], 'keyword', ARGV[3], 'amount', ARGV[4],
+    'original_amount_text', ARGV[5], 'chat_id', ARGV[6], 'chat_title', ARGV[7],
+    'hit_at_ts', ARGV[8], 'finalize_at', ARGV[9], 'sent', 0)
+  redis.call('EXPIRE', key, tonumber(ARGV[10]))
+  redis.call('ZADD', KEYS[2], tonumber(ARGV[9]), key)
+  return {1, amount, now_ts, tonumber(ARGV[9])}
+end
+local cur_amount = tonumber(redis.call('HGET', key, 'amount') or '0') or 0
+local cur_ts = tonumber(redis.call('HGET', key, 'hit_at_ts') or ARGV[8]) or now_ts
+if amount > cur_amount then
+  redis.call('HSET', key, 'keyword', ARGV[3], 'amount', ARGV[4], 'original_amount_text', ARGV[5])
+  cur_amount = amount
+end
+if now_ts < cur_ts then
+  cur_ts = now_ts
+end
+redis.call('HSET', key, 'hit_at_ts', cur_ts)
+if ARGV[6] ~= '0' then
+  redis.call('HSET', key, 'chat_id', ARGV[6])
+end
+if ARGV[7] ~= '' then
+  redis.call('HSET', key, 'chat_title', ARGV[7])
+end
+local finalize_at = tonumber(redis.call('HGET', key, 'finalize_at') or '0') or 0
+return {0, cur_amount, cur_ts, finalize_at}
+"""
+
+
+@dataclass
+class AggregationState:
+    created: bool
+    amount: int
+    hit_at_ts: int
+    finalize_at: int
+
+
+async def upsert_aggregation(
+    redis_client: Any,
+    key: str,
+    username: str,
+    user_id: Optional[int],
+    match: MatchResult,
+    chat_id: Optional[int],
+    chat_title: str,
+    now_ts: int,
+) -> AggregationState:
+    """以单个服务端脚本原子合并一次命中，多个账号同时命中同一用户时结果依然正确。"""
+    res = await redis_client.run_script(
+        AGG_UPSERT_LUA,
+        [key, AGG_DUE_KEY],
+        [
+            username,
+            user_id or 0,
+            match.keyword,
+            match.amount,
+            match.original_amount_text,
+            chat_id or 0,
+            chat_title or "",
+            now_ts,
+            now_ts + AGG_WINDOW_SECONDS,
+            AGG_KEY_TTL_SECONDS,
+        ],
+    )
+    return AggregationState(
+        created=bool(int(res[0])),
+        amount=int(res[1]),
+        hit_at_ts=int(res[2]),
+        finalize_at=int(res[3]),
+    )
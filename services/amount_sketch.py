@@ -0,0 +1,69 @@
+"""
+金额分布的增量统计：
+- 直方图：按 AMOUNT_HIST_WIDTH 的基础宽度分桶计数，查询时可合并为其整数倍的任意宽度；
+- 分位数草图：对数分桶（DDSketch 方式），第 i 桶覆盖 (gamma^(i-1), gamma^i]，
+  由桶代表值估算的任意分位数相对误差不超过 AMOUNT_SKETCH_ALPHA。
+
+两者均按 日 × 关键词 存储计数，桶计数直接相加即可合并任意日期范围与关键词。
+"""
+
+from __future__ import annotations
+
+import math
+import os
+from typing import Dict, Iterable, Optional, Sequence, Tuple
+
+
+AMOUNT_HIST_WIDTH = max(1, int(os.getenv("AMOUNT_HIST_WIDTH", "100") or 100))
+AMOUNT_SKETCH_ALPHA = float(os.getenv("AMOUNT_SKETCH_ALPHA", "0.01") or 0.01)
+SKETCH_GAMMA = (1 + AMOUNT_SKETCH_ALPHA) / (1 - AMOUNT_SKETCH_ALPHA)
+SKETCH_LOG_GAMMA = math.log(SKETCH_GAMMA)
+# 金额 <= 0 的单独归入此桶
+SKETCH_ZERO_BIN = -(2 ** 31)
+
+DEFAULT_QUANTILES = (0.5, 0.9, 0.99)
+
+
+def hist_bucket(amount: int) -> int:
+    return (int(amount) // AMOUNT_HIST_WIDTH) * AMOUNT_HIST_WIDTH
+
+
+def sketch_bin(amount: int) -> int:
+    if amount <= 0:
+        return SKETCH_ZERO_BIN
+    return int(math.ceil(math.log(amount) / SKETCH_LOG_GAMMA))
+
+
+def bin_value(idx: int) -> float:
+    """桶代表值：取使桶内相对误差最小的 2·gamma^i / (gamma + 1)。"""
+    if idx == SKETCH_ZERO_BIN:
+        return 0.0
+    return 2 * SKETCH_GAMMA ** idx / (SKETCH_GAMMA + 1)
+
+
+def quantiles(bins: Iterable[Tuple[int, int]], qs: Sequence[float] = DEFAULT_QUANTILES) -> Dict[str, Optional[int]]:
+    """由合并后的 (桶号, 计数) 估算分位数，返回 {"p50": ..., ...}；无数据时为 None。"""
+    ordered = sorted((int(i), int(c)) for i, c in bins if c)
+    total = sum(c for _, c in ordered)
+    result: Dict[str, Optional[int]] = {}
+    for q in qs:
+        label = f"p{q * 100:g}"
+        if not total:
+            result[label] = None
+            continue
+        # 与 numpy 的 lower 取法一致：第 floor(q·(n-1)) 个值（0 起）
+        rank = int(q * (total - 1))
+        seen = 0
+        for idx, cnt in ordered:
+            seen += cnt
+            if seen > rank:
+                result[label] = int(round(bin_value(idx)))
+                break
+    return result
+
+
+def effective_width(width: Optional[int]) -> int:
+    """查询宽度取基础宽度的整数倍（向下取整，至少为基础宽度）。"""
+    if not width:
+        return AMOUNT_HIST_WIDTH
+    return max(AMOUNT_HIST_WIDTH, (int(width) // AMOUNT_HIST_WIDTH) * AMOUNT_HIST_WIDTH)
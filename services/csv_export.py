@@ -0,0 +1,45 @@
+from __future__ import annotations
+
+import csv
+import io
+import zlib
+from datetime import datetime
+from typing import Any, AsyncIterator, List, Sequence
+
+
+def _cell(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return value.isoformat(sep=" ", timespec="seconds")
+    return value
+
+
+async def stream_csv(
+    header: Sequence[str],
+    chunks: AsyncIterator[List[Sequence[Any]]],
+    gzip: bool = False,
+) -> AsyncIterator[bytes]:
+    """
+    将按块产出的行流式编码为 CSV 字节块：每块写完即交给响应，不在内存中累积整份文件。
+    gzip=True 时以 gzip 格式增量压缩输出。
+    """
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    compressor = zlib.compressobj(wbits=31) if gzip else None
+
+    def drain() -> bytes:
+        data = buf.getvalue().encode("utf-8")
+        buf.seek(0)
+        buf.truncate()
+        return compressor.compress(data) if compressor else data
+
+    writer.writerow(header)
+    async for rows in chunks:
+        writer.writerows([_cell(v) for v in row] for row in rows)
+        out = drain()
+        if out:
+            yield out
+    tail = drain()
+    if compressor:
+        tail += compressor.flush()
+    if tail:
+        yield tail
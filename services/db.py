@@ -1,17 +1,28 @@
 from __future__ import annotations
 
 import asyncio
+import base64
+import hashlib
+import html
+import json
 import logging
 from datetime import datetime
 import os
 import zoneinfo
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, AsyncIterator, Tuple
 
-from sqlalchemy import BigInteger, Integer, String, Text, TIMESTAMP, Boolean, func
+from sqlalchemy import BigInteger, ColumnElement, Integer, String, Text, TIMESTAMP, Boolean, Index, func, text
 from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.ext.asyncio import AsyncAttrs, AsyncSession, create_async_engine, async_sessionmaker
 from urllib.parse import urlparse
 from sqlalchemy.orm import Mapped, mapped_column, sessionmaker, DeclarativeBase
+from sqlalchemy.pool import NullPool
+
+from . import partitions
+from . import amount_sketch
+from .db_pool import engine_options, pool_stats
+from .leaderboard import Leaderboard
+from .unique_counter import UniqueUserCounter
 
 
 logger = logging.getLogger(__name__)
@@ -38,11 +49,198 @@ class Hit(Base):
     amount: Mapped[int] = mapped_column(Integer, index=True)
     chat_id: Mapped[Optional[int]] = mapped_column(BigInteger, index=True, nullable=True)
     chat_title: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
-    hit_at: Mapped[datetime] = mapped_column(TIMESTAMP(timezone=False), index=True)
+    # 写入时计算的规范化用户名（去 HTML 转义、小写、带 @）与机器人标记，查询不再依赖 lower()/LIKE
+    username_lc: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    is_bot: Mapped[bool] = mapped_column(Boolean, default=False, server_default=text("false"))
+    # 分区键：分区表的主键必须包含 hit_at，故与 id 组成联合主键
+    hit_at: Mapped[datetime] = mapped_column(TIMESTAMP(timezone=False), primary_key=True, index=True)
     created_at: Mapped[datetime] = mapped_column(
         TIMESTAMP(timezone=False), server_default=func.now(), index=True
     )
 
+    __table_args__ = (
+        # 游标分页：ORDER BY hit_at DESC, id DESC 直接走该索引
+        Index("ix_hits_hit_at_id", "hit_at", "id"),
+        # 精确用户名查询
+        Index("ix_hits_username_lc", "username_lc"),
+        # exclude_bots=True 的列表/分页查询走部分索引
+        Index("ix_hits_nobot_hit_at_id", "hit_at", "id", postgresql_where=text("NOT is_bot")),
+        # 待回填规范化列的历史记录；回填完成后为空，启动时的回填检查无需扫表
+        Index(
+            "ix_hits_username_lc_pending", "id",
+            postgresql_where=text("username_lc IS NULL AND username IS NOT NULL AND username <> ''"),
+        ),
+        # 新建库时直接创建为按月范围分区表；旧库通过 migrate_hits_to_partitioned 迁移
+        {"postgresql_partition_by": "RANGE (hit_at)"},
+    )
+
+
+def encode_cursor(direction: str, hit_at: datetime, hit_id: int) -> str:
+    """生成不透明分页游标；direction 为 n（下一页）或 p（上一页）。"""
+    raw = f"{direction}|{hit_at.isoformat()}|{hit_id}"
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[str, datetime, int]:
+    padded = cursor + "=" * (-len(cursor) % 4)
+    direction, ts, hit_id = base64.urlsafe_b64decode(padded.encode("ascii")).decode("utf-8").split("|")
+    if direction not in ("n", "p"):
+        raise ValueError(f"非法游标方向：{direction}")
+    return direction, datetime.fromisoformat(ts), int(hit_id)
+
+
+def _hour_bucket(ts: datetime) -> datetime:
+    return ts.replace(minute=0, second=0, microsecond=0)
+
+
+def _day_bucket(ts: datetime) -> datetime:
+    return ts.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _is_bot_name(username: Optional[str]) -> bool:
+    # 用户名包含 bot 子串（大小写不敏感）即视为机器人
+    return "bot" in (username or "").lower()
+
+
+def canonical_username(username: Optional[str]) -> Optional[str]:
+    """规范化用户名：还原 HTML 转义、去空白、小写，并统一带 @ 前缀。"""
+    u = html.unescape(username or "").strip()
+    if not u:
+        return None
+    return "@" + u.lstrip("@").lower()
+
+
+class HitRollupChat(Base):
+    """按 小时 × 关键词 × 群 的命中汇总，与 hits 写入在同一事务内增量维护。"""
+
+    __tablename__ = "hit_rollup_hourly_chat"
+
+    bucket: Mapped[datetime] = mapped_column(TIMESTAMP(timezone=False), primary_key=True)
+    keyword: Mapped[str] = mapped_column(String(16), primary_key=True)
+    # 无群 id 的命中记为 0
+    chat_id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    chat_title: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    hits: Mapped[int] = mapped_column(Integer, default=0)
+    bot_hits: Mapped[int] = mapped_column(Integer, default=0)
+    amount_sum: Mapped[int] = mapped_column(BigInteger, default=0)
+
+    __table_args__ = (
+        Index("ix_hit_rollup_hourly_chat_chat", "chat_id"),
+    )
+
+
+class HitRollupUser(Base):
+    """按 小时 × 群 × 用户 的命中汇总，用于排行榜与每群去重用户数。"""
+
+    __tablename__ = "hit_rollup_hourly_user"
+
+    bucket: Mapped[datetime] = mapped_column(TIMESTAMP(timezone=False), primary_key=True)
+    chat_id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    username: Mapped[str] = mapped_column(Text, primary_key=True)
+    hits: Mapped[int] = mapped_column(Integer, default=0)
+    amount_sum: Mapped[int] = mapped_column(BigInteger, default=0)
+
+    __table_args__ = (
+        Index("ix_hit_rollup_hourly_user_username", "username"),
+        # 按群统计去重用户数（可限定到当前页的群）
+        Index("ix_hit_rollup_hourly_user_chat", "chat_id", "username"),
+    )
+
+
+class HitAmountHist(Base):
+    """按 日 × 关键词 × 金额档（宽度 AMOUNT_HIST_WIDTH）的命中计数，查询时可合并为更宽的档。"""
+
+    __tablename__ = "hit_amount_hist_daily"
+
+    day: Mapped[datetime] = mapped_column(TIMESTAMP(timezone=False), primary_key=True)
+    keyword: Mapped[str] = mapped_column(String(16), primary_key=True)
+    bucket: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    hits: Mapped[int] = mapped_column(BigInteger, default=0)
+
+
+class HitAmountSketch(Base):
+    """按 日 × 关键词 的金额分位数草图（对数分桶计数，可相加合并），见 services/amount_sketch.py。"""
+
+    __tablename__ = "hit_amount_sketch_daily"
+
+    day: Mapped[datetime] = mapped_column(TIMESTAMP(timezone=False), primary_key=True)
+    keyword: Mapped[str] = mapped_column(String(16), primary_key=True)
+    bin: Mapped[int] = mapped_column(Integer, primary_key=True)
+    hits: Mapped[int] = mapped_column(BigInteger, default=0)
+
+
+def like_pattern(q: str) -> str:
+    """子串匹配模式：转义用户输入中的 LIKE 通配符。"""
+    escaped = q.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+
+def text_search(column: Any, q: str, fuzzy: bool = False, trgm_available: bool = False) -> Any:
+    """
+    子串/模糊搜索条件。有 pg_trgm 时 ILIKE 子串匹配可直接走 GIN 三元组索引；
+    fuzzy=True 且扩展可用时改用相似度运算符 %（阈值见 pg_trgm.similarity_threshold），否则回退为 ILIKE。
+    """
+    if fuzzy and trgm_available:
+        return column.op("%")(q)
+    return column.ilike(like_pattern(q))
+
+
+# 展示用时间格式，在 SQL 中直接格式化，省去逐行 isoformat（等价于 isoformat(sep=" ", timespec="seconds")）
+TS_FORMAT = "YYYY-MM-DD HH24:MI:SS"
+
+
+def ts_text(column: Any, label: str) -> Any:
+    return func.to_char(column, TS_FORMAT).label(label)
+
+
+def history_columns() -> List[Any]:
+    """历史记录/导出的列：只取展示所需列，时间列已格式化为文本。"""
+    return [
+        Hit.id, Hit.username, Hit.user_id, Hit.keyword, Hit.amount, Hit.chat_id, Hit.chat_title,
+        ts_text(Hit.hit_at, "hit_at"), ts_text(Hit.created_at, "created_at"),
+    ]
+
+
+HISTORY_FIELDS = ("id", "username", "user_id", "keyword", "amount", "chat_id", "chat_title", "hit_at", "created_at")
+
+
+# pg_trgm 三元组 GIN 索引（依赖扩展，故不在模型中声明）
+TRGM_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS ix_hits_username_lc_trgm ON hits USING gin (username_lc gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_hits_chat_title_trgm ON hits USING gin (chat_title gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_groups_title_trgm ON groups USING gin (title gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_groups_username_trgm ON groups USING gin (username gin_trgm_ops)",
+]
+
+
+# 已有库的幂等补列语句（新库由 create_all 直接建出）
+SCHEMA_MIGRATIONS = [
+    "ALTER TABLE hits ADD COLUMN IF NOT EXISTS username_lc TEXT",
+    "ALTER TABLE hits ADD COLUMN IF NOT EXISTS is_bot BOOLEAN NOT NULL DEFAULT false",
+]
+
+
+# 命中数据版本号：每次写入 hits 后自增，基于它的缓存键在新数据写入后自然失效
+DATA_VERSION_KEY = "wd:data:ver"
+COUNT_CACHE_PREFIX = "wd:cnt:"
+
+# 计数策略
+COUNT_EXACT = "exact"        # 精确 count(*)
+COUNT_CACHED = "cached"      # 精确计数结果按筛选条件缓存到 Redis
+COUNT_ESTIMATE = "estimate"  # 查询规划器估算值
+COUNT_CAPPED = "capped"      # 最多数到上限，超出时返回“至少 N 条”
+COUNT_AUTO = "auto"          # 无筛选条件时用估算，否则用缓存的精确计数
+COUNT_STRATEGIES = (COUNT_EXACT, COUNT_CACHED, COUNT_ESTIMATE, COUNT_CAPPED, COUNT_AUTO)
+# 表级行数估算：非分区表取自身，分区表取各分区之和
+ESTIMATE_HITS_SQL = """
+SELECT COALESCE(sum(GREATEST(c.reltuples, 0)), 0)::bigint
+FROM pg_class c
+WHERE (c.oid = 'hits'::regclass AND c.relkind = 'r')
+   OR c.oid IN (SELECT i.inhrelid FROM pg_inherits i WHERE i.inhparent = 'hits'::regclass)
+"""
+# 筛选参数中的开关项：始终有值，不算作用户筛选条件（仍参与计数缓存键）
+COUNT_FLAG_KEYS = ("exclude_bots", "fuzzy")
+
 
 class Group(Base):
     __tablename__ = "groups"
@@ -57,42 +255,400 @@ class Group(Base):
     created_at: Mapped[datetime] = mapped_column(TIMESTAMP(timezone=False), server_default=func.now())
 
 
+def _env_int(name: str, default: int) -> int:
+    return int(os.getenv(name, str(default)) or default)
+
+
 class Database:
-    def __init__(self, database_url: str) -> None:
+    def __init__(self, database_url: str, read_database_url: Optional[str] = None) -> None:
         # 若 .env 为 docker 主机名 postgres，本地直跑时可通过环境覆盖或使用 docker compose
         self.database_url = database_url
-        self.engine = create_async_engine(database_url, future=True, echo=False)
+        # 读库地址可指向只读副本；未配置时与写库同址，但使用独立连接池
+        self.read_database_url = read_database_url or os.getenv("DATABASE_READ_URL") or database_url
+        pool_timeout = float(os.getenv("DB_POOL_TIMEOUT", "10") or 10)
+        # 写池：转发路径的命中落库与群组目录写入，语句超时短，避免被慢查询拖住
+        self.engine = create_async_engine(
+            database_url,
+            future=True,
+            echo=False,
+            **engine_options(
+                "write",
+                pool_size=_env_int("DB_WRITE_POOL_SIZE", 5),
+                max_overflow=_env_int("DB_WRITE_MAX_OVERFLOW", 5),
+                pool_timeout=pool_timeout,
+                statement_timeout_ms=_env_int("DB_WRITE_STATEMENT_TIMEOUT_MS", 5000),
+            ),
+        )
+        # 读池：仪表盘/API 查询与导出，慢查询只会占满自己的池
+        self.read_engine = create_async_engine(
+            self.read_database_url,
+            future=True,
+            echo=False,
+            **engine_options(
+                "read",
+                pool_size=_env_int("DB_READ_POOL_SIZE", 10),
+                max_overflow=_env_int("DB_READ_MAX_OVERFLOW", 10),
+                pool_timeout=pool_timeout,
+                statement_timeout_ms=_env_int("DB_READ_STATEMENT_TIMEOUT_MS", 30000),
+            ),
+        )
+        # 维护引擎：建表、迁移、回填、归档等长任务，不设语句超时，也不常驻连接
+        self.admin_engine = create_async_engine(database_url, future=True, echo=False, poolclass=NullPool)
         # 使用 async_sessionmaker，确保类型正确（AsyncEngine -> AsyncSession）
         self.async_session_factory = async_sessionmaker(
             bind=self.engine, expire_on_commit=False
         )
+        self.read_session_factory = async_sessionmaker(
+            bind=self.read_engine, expire_on_commit=False
+        )
+        # 可选的 Redis 客户端，用于计数缓存、数据版本号与排行榜
+        self.redis: Optional[Any] = None
+        self.leaderboard: Optional[Leaderboard] = None
+        self.unique_counter: Optional[UniqueUserCounter] = None
+        self.count_cache_ttl = int(os.getenv("COUNT_CACHE_TTL", "30") or 30)
+        self.count_cap = int(os.getenv("COUNT_CAP", "10000") or 10000)
+        # 分区维护：预建未来分区的月数；保留月数为 0 表示不做归档清理
+        self.partition_months_ahead = int(os.getenv("HITS_PARTITION_AHEAD", "3") or 3)
+        self.retention_months = int(os.getenv("HITS_RETENTION_MONTHS", "0") or 0)
+        self.archive_dir = os.getenv("HITS_ARCHIVE_DIR", "./data/archive")
+        # pg_trgm 是否可用，由 init_models 探测
+        self.trgm_available = False
+
+    def attach_redis(self, redis_client: Any) -> None:
+        self.redis = redis_client
+        self.leaderboard = Leaderboard(redis_client, TZ)
+        self.unique_counter = UniqueUserCounter(
+            redis_client, TZ, day_retention_days=int(os.getenv("HLL_DAY_RETENTION_DAYS", "400") or 400)
+        )
+
+    async def data_version(self) -> int:
+        if self.redis is None:
+            return 0
+        try:
+            return int(await self.redis.client.get(DATA_VERSION_KEY) or 0)
+        except Exception:
+            return 0
+
+    async def _bump_data_version(self) -> None:
+        if self.redis is None:
+            return
+        try:
+            await self.redis.client.incr(DATA_VERSION_KEY)
+        except Exception as e:
+            logger.warning("更新数据版本号失败：%s", e)
 
     async def init_models(self) -> None:
-        async with self.engine.begin() as conn:
+        async with self.admin_engine.begin() as conn:
             await conn.run_sync(Base.metadata.create_all)
+            # create_all 不会给已存在的表补列，这里执行幂等的补列语句
+            for stmt in SCHEMA_MIGRATIONS:
+                await conn.execute(text(stmt))
+            # create_all 不会给已存在的表补建新索引，这里逐个按需创建
+            await conn.run_sync(self._create_missing_indexes)
+            if await partitions.is_partitioned(conn):
+                await partitions.ensure_partitions(conn, datetime.now(), self.partition_months_ahead)
+            else:
+                logger.warning("hits 仍为非分区表，可执行 `python main.py --partition-hits` 迁移为按月分区。")
+        await self._init_trgm()
+        # 补列前写入的历史记录 username_lc 为空、is_bot 为 false，精确用户名查询与排除机器人都依赖它们，启动时分批回填
+        await self.backfill_username_columns()
         logger.info("数据库表结构检查完成（如不存在则自动创建）。")
 
+    async def _init_trgm(self) -> None:
+        """启用 pg_trgm 并创建三元组索引；无权限或扩展不可用时回退为普通 ILIKE 搜索。"""
+        try:
+            async with self.admin_engine.begin() as conn:
+                await conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+                for stmt in TRGM_INDEXES:
+                    await conn.execute(text(stmt))
+            self.trgm_available = True
+        except Exception as e:
+            self.trgm_available = False
+            logger.warning("pg_trgm 不可用，子串搜索将回退为顺序扫描：%s", e)
+
+    async def ensure_partitions(self) -> None:
+        async with self.admin_engine.begin() as conn:
+            if await partitions.is_partitioned(conn):
+                await partitions.ensure_partitions(conn, datetime.now(), self.partition_months_ahead)
+
+    async def migrate_hits_to_partitioned(self) -> int:
+        """
+        将旧的非分区 hits 表迁移为按月分区表（单事务，期间阻塞写入）：
+        旧表改名为 hits_legacy -> 按模型新建分区表 -> 补齐历史月份分区 -> 复制数据 -> 校正序列 -> 删除旧表。
+        """
+        from sqlalchemy import text
+
+        async with self.admin_engine.begin() as conn:
+            if await partitions.is_partitioned(conn):
+                logger.info("hits 已是分区表，无需迁移。")
+                return 0
+            await conn.execute(text("LOCK TABLE hits IN ACCESS EXCLUSIVE MODE"))
+            await conn.execute(text("ALTER TABLE hits RENAME TO hits_legacy"))
+            await partitions.rename_legacy_objects(conn, "hits_legacy")
+            await conn.run_sync(lambda c: Base.metadata.tables["hits"].create(c))
+            oldest = (await conn.execute(text("SELECT min(hit_at) FROM hits_legacy"))).scalar()
+            await partitions.ensure_partitions(conn, oldest or datetime.now(), self.partition_months_ahead)
+            legacy_cols = {
+                r[0] for r in (await conn.execute(text(
+                    "SELECT column_name FROM information_schema.columns WHERE table_name = 'hits_legacy'"
+                ))).all()
+            }
+            cols = ", ".join(c.name for c in Hit.__table__.columns if c.name in legacy_cols)
+            res = await conn.execute(text(f"INSERT INTO hits ({cols}) SELECT {cols} FROM hits_legacy"))
+            await conn.execute(text(
+                "SELECT setval(pg_get_serial_sequence('hits', 'id'), COALESCE((SELECT max(id) FROM hits), 0) + 1, false)"
+            ))
+            await conn.execute(text("DROP TABLE hits_legacy"))
+        moved = int(res.rowcount or 0)
+        logger.info("hits 已迁移为按月分区表：%s 行", moved)
+        return moved
+
+    async def run_retention(self) -> List[Tuple[str, str, int]]:
+        """预建未来分区，并将超出保留期的分区归档到本地压缩文件后删除（汇总表数据不受影响）。"""
+        await self.ensure_partitions()
+        if self.retention_months <= 0:
+            return []
+        async with self.admin_engine.connect() as conn:
+            if not await partitions.is_partitioned(conn):
+                return []
+        cutoff = partitions.add_months(partitions.month_start(datetime.now()), -self.retention_months)
+        archived = await partitions.detach_and_archive(self.admin_engine, cutoff, self.archive_dir)
+        if archived:
+            await self._bump_data_version()
+        return archived
+
+    @staticmethod
+    def _create_missing_indexes(sync_conn) -> None:
+        for table in Base.metadata.sorted_tables:
+            for idx in table.indexes:
+                idx.create(sync_conn, checkfirst=True)
+
     def get_session(self) -> AsyncSession:
+        """写池会话。"""
         return self.async_session_factory()
 
+    def get_read_session(self) -> AsyncSession:
+        """读池会话（可能指向只读副本，数据有复制延迟）。"""
+        return self.read_session_factory()
+
+    def pool_stats(self) -> Dict[str, Any]:
+        return {"write": pool_stats(self.engine), "read": pool_stats(self.read_engine)}
+
+    async def dispose(self) -> None:
+        for engine in (self.engine, self.read_engine, self.admin_engine):
+            await engine.dispose()
+
+    @staticmethod
+    def _hit_row(data: Dict[str, Any]) -> Dict[str, Any]:
+        # 让 created_at 与业务命中时间保持一致，避免视觉上“时间/创建时间”不一致
+        hit_time = data["hit_at"]
+        username_lc = canonical_username(data.get("username"))
+        return {
+            "username": data.get("username"),
+            "username_lc": username_lc,
+            "is_bot": _is_bot_name(username_lc),
+            "user_id": data.get("user_id"),
+            "keyword": data["keyword"],
+            "amount": int(data["amount"]),
+            "chat_id": data.get("chat_id"),
+            "chat_title": data.get("chat_title"),
+            "hit_at": hit_time,
+            "created_at": hit_time,
+        }
+
     async def insert_hit(self, data: Dict[str, Any]) -> int:
+        ids = await self.insert_hits([data])
+        return ids[0]
+
+    async def insert_hits(self, items: List[Dict[str, Any]]) -> List[int]:
+        """批量写入命中记录：单个事务、多行 INSERT ... RETURNING，返回新记录 id。"""
+        if not items:
+            return []
+        from sqlalchemy import insert
+
+        rows = [self._hit_row(d) for d in items]
         async with self.get_session() as session:
-            # 让 created_at 与业务命中时间保持一致，避免视觉上“时间/创建时间”不一致
-            hit_time = data["hit_at"]
-            hit = Hit(
-                username=data.get("username"),
-                user_id=data.get("user_id"),
-                keyword=data["keyword"],
-                amount=int(data["amount"]),
-                chat_id=data.get("chat_id"),
-                chat_title=data.get("chat_title"),
-                hit_at=hit_time,
-                created_at=hit_time,
-            )
-            session.add(hit)
+            result = await session.execute(insert(Hit).returning(Hit.id, sort_by_parameter_order=True), rows)
+            ids = [int(r[0]) for r in result.all()]
+            await self._apply_rollups(session, rows)
             await session.commit()
-            await session.refresh(hit)
-            return hit.id
+        await self._bump_data_version()
+        if self.leaderboard is not None:
+            try:
+                await self.leaderboard.record(rows)
+            except Exception as e:
+                # 排行榜可由 --rebuild-leaderboards 从汇总表重建，这里不影响落库
+                logger.warning("更新排行榜失败：%s", e)
+        if self.unique_counter is not None:
+            try:
+                await self.unique_counter.record(rows)
+            except Exception as e:
+                logger.warning("更新去重用户 HLL 失败：%s", e)
+        return ids
+
+    @staticmethod
+    async def _apply_rollups(session: AsyncSession, rows: List[Dict[str, Any]]) -> None:
+        """将一批命中累加到小时汇总表；先在内存中合并同键行，避免单条 INSERT 内重复冲突。"""
+        chat_acc: Dict[Tuple[datetime, str, int], Dict[str, Any]] = {}
+        user_acc: Dict[Tuple[datetime, int, str], Dict[str, Any]] = {}
+        hist_acc: Dict[Tuple[datetime, str, int], int] = {}
+        sketch_acc: Dict[Tuple[datetime, str, int], int] = {}
+        for r in rows:
+            day = _day_bucket(r["hit_at"])
+            amount = int(r["amount"])
+            hk = (day, r["keyword"], amount_sketch.hist_bucket(amount))
+            hist_acc[hk] = hist_acc.get(hk, 0) + 1
+            sk = (day, r["keyword"], amount_sketch.sketch_bin(amount))
+            sketch_acc[sk] = sketch_acc.get(sk, 0) + 1
+            bucket = _hour_bucket(r["hit_at"])
+            chat_id = int(r.get("chat_id") or 0)
+            is_bot = _is_bot_name(r.get("username"))
+            c = chat_acc.setdefault(
+                (bucket, r["keyword"], chat_id),
+                {"bucket": bucket, "keyword": r["keyword"], "chat_id": chat_id, "chat_title": None,
+                 "hits": 0, "bot_hits": 0, "amount_sum": 0},
+            )
+            c["hits"] += 1
+            c["bot_hits"] += int(is_bot)
+            c["amount_sum"] += int(r["amount"])
+            c["chat_title"] = r.get("chat_title") or c["chat_title"]
+            if r.get("username"):
+                u = user_acc.setdefault(
+                    (bucket, chat_id, r["username"]),
+                    {"bucket": bucket, "chat_id": chat_id, "username": r["username"], "hits": 0, "amount_sum": 0},
+                )
+                u["hits"] += 1
+                u["amount_sum"] += int(r["amount"])
+
+        if chat_acc:
+            stmt = pg_insert(HitRollupChat).values(list(chat_acc.values()))
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[HitRollupChat.bucket, HitRollupChat.keyword, HitRollupChat.chat_id],
+                set_=dict(
+                    hits=HitRollupChat.hits + stmt.excluded.hits,
+                    bot_hits=HitRollupChat.bot_hits + stmt.excluded.bot_hits,
+                    amount_sum=HitRollupChat.amount_sum + stmt.excluded.amount_sum,
+                    chat_title=func.coalesce(stmt.excluded.chat_title, HitRollupChat.chat_title),
+                ),
+            )
+            await session.execute(stmt)
+        if user_acc:
+            stmt = pg_insert(HitRollupUser).values(list(user_acc.values()))
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[HitRollupUser.bucket, HitRollupUser.chat_id, HitRollupUser.username],
+                set_=dict(
+                    hits=HitRollupUser.hits + stmt.excluded.hits,
+                    amount_sum=HitRollupUser.amount_sum + stmt.excluded.amount_sum,
+                ),
+            )
+            await session.execute(stmt)
+        for model, col, acc in (
+            (HitAmountHist, "bucket", hist_acc),
+            (HitAmountSketch, "bin", sketch_acc),
+        ):
+            if not acc:
+                continue
+            stmt = pg_insert(model).values([
+                {"day": day, "keyword": kw, col: key, "hits": n} for (day, kw, key), n in acc.items()
+            ])
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[model.day, model.keyword, getattr(model, col)],
+                set_=dict(hits=model.hits + stmt.excluded.hits),
+            )
+            await session.execute(stmt)
+
+    async def backfill_username_columns(self, batch_size: int = 10000) -> int:
+        """为补列前写入的历史记录分批回填 username_lc 与 is_bot，每批单独提交，避免长事务；幂等，无待回填记录时立即返回。"""
+        total = 0
+        while True:
+            async with self.admin_engine.begin() as conn:
+                res = await conn.execute(
+                    text(
+                        """
+                        UPDATE hits SET
+                            -- Telegram 用户名仅含字母数字与下划线，HTML 转义不影响其内容
+                            username_lc = '@' || lower(ltrim(trim(username), '@')),
+                            is_bot = lower(username) LIKE '%bot%'
+                        WHERE id IN (
+                            SELECT id FROM hits
+                            WHERE username IS NOT NULL AND username <> '' AND username_lc IS NULL
+                            LIMIT :n
+                        )
+                        """
+                    ),
+                    {"n": batch_size},
+                )
+            done = int(res.rowcount or 0)
+            total += done
+            if done < batch_size:
+                break
+            logger.info("用户名规范化列回填中：已处理 %s 行", total)
+        if total:
+            await self._bump_data_version()
+            logger.info("用户名规范化列回填完成：%s 行", total)
+        return total
+
+    async def rebuild_rollups(self) -> Dict[str, int]:
+        """从 hits 全量重建小时汇总表（用于首次上线或数据修复）；期间短暂阻塞写入以保证一致。"""
+        from sqlalchemy import text
+
+        async with self.admin_engine.begin() as conn:
+            await conn.execute(text("LOCK TABLE hits IN SHARE MODE"))
+            await conn.execute(text(
+                "TRUNCATE hit_rollup_hourly_chat, hit_rollup_hourly_user, hit_amount_hist_daily, hit_amount_sketch_daily"
+            ))
+            chat_res = await conn.execute(text(
+                """
+                INSERT INTO hit_rollup_hourly_chat (bucket, keyword, chat_id, chat_title, hits, bot_hits, amount_sum)
+                SELECT date_trunc('hour', hit_at), keyword, COALESCE(chat_id, 0), max(chat_title),
+                       count(*), count(*) FILTER (WHERE is_bot), COALESCE(sum(amount), 0)
+                FROM hits
+                GROUP BY 1, 2, 3
+                """
+            ))
+            user_res = await conn.execute(text(
+                """
+                INSERT INTO hit_rollup_hourly_user (bucket, chat_id, username, hits, amount_sum)
+                SELECT date_trunc('hour', hit_at), COALESCE(chat_id, 0), username, count(*), COALESCE(sum(amount), 0)
+                FROM hits
+                WHERE username IS NOT NULL
+                GROUP BY 1, 2, 3
+                """
+            ))
+            hist_res = await conn.execute(
+                text(
+                    """
+                    INSERT INTO hit_amount_hist_daily (day, keyword, bucket, hits)
+                    SELECT date_trunc('day', hit_at), keyword, floor(amount::numeric / :w) * :w, count(*)
+                    FROM hits
+                    GROUP BY 1, 2, 3
+                    """
+                ),
+                {"w": amount_sketch.AMOUNT_HIST_WIDTH},
+            )
+            # 与 amount_sketch.sketch_bin 一致：ceil(ln(amount) / ln(gamma))，非正金额归入零桶
+            sketch_res = await conn.execute(
+                text(
+                    """
+                    INSERT INTO hit_amount_sketch_daily (day, keyword, bin, hits)
+                    SELECT date_trunc('day', hit_at), keyword,
+                           CASE WHEN amount > 0 THEN ceil(ln(amount) / :lg)::int ELSE :zero END,
+                           count(*)
+                    FROM hits
+                    GROUP BY 1, 2, 3
+                    """
+                ),
+                {"lg": amount_sketch.SKETCH_LOG_GAMMA, "zero": amount_sketch.SKETCH_ZERO_BIN},
+            )
+        await self._bump_data_version()
+        result = {
+            "chat_rows": int(chat_res.rowcount or 0),
+            "user_rows": int(user_res.rowcount or 0),
+            "amount_hist_rows": int(hist_res.rowcount or 0),
+            "amount_sketch_rows": int(sketch_res.rowcount or 0),
+        }
+        logger.info("小时汇总表重建完成：%s", result)
+        return result
 
     async def upsert_groups(self, groups: List[Dict[str, Any]]) -> None:
         if not groups:
@@ -119,14 +675,18 @@ class Database:
         q: Optional[str] = None,
         is_megagroup: Optional[bool] = None,
         is_broadcast: Optional[bool] = None,
+        fuzzy: bool = False,
+        exact: bool = False,
     ) -> Dict[str, Any]:
-        async with self.get_session() as session:
+        async with self.get_read_session() as session:
             from sqlalchemy import select, and_, or_, desc
 
             conditions = []
             if q:
-                like = f"%{q}%"
-                conditions.append(or_(Group.title.ilike(like), Group.username.ilike(like)))
+                conditions.append(or_(
+                    text_search(Group.title, q, fuzzy, self.trgm_available),
+                    text_search(Group.username, q, fuzzy, self.trgm_available),
+                ))
             if is_megagroup is not None:
                 conditions.append(Group.is_megagroup.is_(is_megagroup))
             if is_broadcast is not None:
@@ -139,28 +699,139 @@ class Database:
                 total_stmt = total_stmt.where(where_clause)
             total = (await session.execute(total_stmt)).scalar_one()
 
-            stmt = select(Group).order_by(desc(Group.updated_at)).offset((page - 1) * page_size).limit(page_size)
+            stmt = select(
+                Group.id, Group.title, Group.username, Group.is_megagroup, Group.is_broadcast,
+                ts_text(Group.updated_at, "updated_at"), ts_text(Group.created_at, "created_at"),
+            ).order_by(desc(Group.updated_at)).offset((page - 1) * page_size).limit(page_size)
             if where_clause is not None:
                 stmt = stmt.where(where_clause)
-            rows = (await session.execute(stmt)).scalars().all()
+            rows = (await session.execute(stmt)).all()
 
-            # 追加每群的去重触发用户数
-            uniq_map = { (row["chat_id"]): row["unique_users"] for row in await self.query_group_unique_user_counts() }
+            # 追加每群的去重触发用户数：只统计当前页的群，代价与页大小相关而与历史总量无关
+            page_ids = [r.id for r in rows]
+            uniq_map = {
+                row["chat_id"]: row["unique_users"]
+                for row in await self.query_group_unique_user_counts(chat_ids=page_ids, exact=exact)
+            } if page_ids else {}
             items = []
             for r in rows:
-                items.append({
-                    "id": r.id,
-                    "title": r.title,
-                    "username": r.username,
-                    "is_megagroup": r.is_megagroup,
-                    "is_broadcast": r.is_broadcast,
-                    "updated_at": r.updated_at.isoformat(sep=" ", timespec="seconds") if r.updated_at else None,
-                    "created_at": r.created_at.isoformat(sep=" ", timespec="seconds") if r.created_at else None,
-                    "unique_users": int(uniq_map.get(r.id, 0)),
-                })
+                item = dict(r._mapping)
+                item["unique_users"] = int(uniq_map.get(r.id, 0))
+                items.append(item)
 
             return {"total": total, "page": page, "page_size": page_size, "items": items}
 
+    @staticmethod
+    def _history_conditions(
+        username: Optional[str] = None,
+        keyword: Optional[str] = None,
+        chat_id: Optional[int] = None,
+        chat_title: Optional[str] = None,
+        start_time: Optional[datetime] = None,
+        end_time: Optional[datetime] = None,
+        min_amount: Optional[int] = None,
+        exclude_bots: bool = True,
+        username_q: Optional[str] = None,
+        chat_title_q: Optional[str] = None,
+        fuzzy: bool = False,
+        trgm_available: bool = False,
+    ) -> List[Any]:
+        from sqlalchemy import not_
+
+        conditions: List[Any] = []
+        if username:
+            conditions.append(Hit.username_lc == canonical_username(username))
+        if keyword:
+            conditions.append(Hit.keyword == keyword)
+        if chat_id:
+            conditions.append(Hit.chat_id == chat_id)
+        if chat_title:
+            conditions.append(Hit.chat_title == chat_title)
+        if start_time:
+            conditions.append(Hit.hit_at >= start_time)
+        if end_time:
+            conditions.append(Hit.hit_at <= end_time)
+        if min_amount is not None:
+            conditions.append(Hit.amount >= int(min_amount))
+        if exclude_bots:
+            # 排除机器人用户名（写入时预先计算的 is_bot，可命中部分索引）
+            conditions.append(not_(Hit.is_bot))
+        if username_q:
+            conditions.append(text_search(Hit.username_lc, username_q.lower(), fuzzy, trgm_available))
+        if chat_title_q:
+            conditions.append(text_search(Hit.chat_title, chat_title_q, fuzzy, trgm_available))
+        return conditions
+
+    async def _count_hits(
+        self,
+        session: AsyncSession,
+        conditions: List[Any],
+        filters: Dict[str, Any],
+        strategy: str = COUNT_EXACT,
+    ) -> Tuple[int, str, bool]:
+        """按指定策略统计命中条数；返回 (条数, 实际使用的策略, 是否为精确值)。"""
+        from sqlalchemy import select, and_, text
+
+        where_clause = and_(*conditions) if conditions else None
+        has_user_filters = any(v not in (None, "") for k, v in filters.items() if k not in COUNT_FLAG_KEYS)
+        if strategy == COUNT_AUTO:
+            strategy = COUNT_ESTIMATE if not has_user_filters else COUNT_CACHED
+        if strategy == COUNT_CACHED and self.redis is None:
+            strategy = COUNT_EXACT
+
+        if strategy == COUNT_ESTIMATE:
+            try:
+                if where_clause is None:
+                    # 无任何条件：直接读取表统计信息。分区表父表不会被 ANALYZE（reltuples 恒为 -1），
+                    # 需累加各分区的估算值；未分析过的表 reltuples 为 -1，按 0 计
+                    est = (await session.execute(text(ESTIMATE_HITS_SQL))).scalar_one()
+                else:
+                    stmt = select(Hit.id).where(where_clause)
+                    sql = str(stmt.compile(dialect=session.get_bind().dialect, compile_kwargs={"literal_binds": True}))
+                    plan = (await session.execute(text("EXPLAIN (FORMAT JSON) " + sql))).scalar_one()
+                    if isinstance(plan, str):
+                        plan = json.loads(plan)
+                    est = plan[0]["Plan"]["Plan Rows"]
+                return max(0, int(est)), COUNT_ESTIMATE, False
+            except Exception as e:
+                logger.debug("估算计数失败，回退到精确计数：%s", e)
+                strategy = COUNT_EXACT
+
+        if strategy == COUNT_CAPPED:
+            inner = select(Hit.id)
+            if where_clause is not None:
+                inner = inner.where(where_clause)
+            sub = inner.limit(self.count_cap + 1).subquery()
+            n = int((await session.execute(select(func.count()).select_from(sub))).scalar_one())
+            if n > self.count_cap:
+                return self.count_cap, COUNT_CAPPED, False
+            return n, COUNT_CAPPED, True
+
+        cache_key = None
+        if strategy == COUNT_CACHED:
+            version = await self.data_version()
+            digest = hashlib.sha1(json.dumps(filters, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+            cache_key = f"{COUNT_CACHE_PREFIX}{version}:{digest}"
+            try:
+                cached = await self.redis.client.get(cache_key)  # type: ignore[union-attr]
+            except Exception:
+                cached = None
+            if cached is not None:
+                return int(cached), COUNT_CACHED, True
+
+        total_stmt = select(func.count(Hit.id))
+        if where_clause is not None:
+            total_stmt = total_stmt.where(where_clause)
+        total = int((await session.execute(total_stmt)).scalar_one())
+
+        if cache_key is not None:
+            try:
+                await self.redis.client.set(cache_key, total, ex=self.count_cache_ttl)  # type: ignore[union-attr]
+            except Exception:
+                pass
+            return total, COUNT_CACHED, True
+        return total, COUNT_EXACT, True
+
     async def query_history(
         self,
         page: int = 1,
@@ -173,123 +844,357 @@ class Database:
         end_time: Optional[datetime] = None,
         min_amount: Optional[int] = None,
         exclude_bots: bool = True,
+        cursor: Optional[str] = None,
+        count_strategy: str = COUNT_EXACT,
+        username_q: Optional[str] = None,
+        chat_title_q: Optional[str] = None,
+        fuzzy: bool = False,
     ) -> Dict[str, Any]:
-        async with self.get_session() as session:
-            from sqlalchemy import select, and_, desc, not_, or_
-
-            conditions = []
-            if username:
-                conditions.append(Hit.username == username)
-            if keyword:
-                conditions.append(Hit.keyword == keyword)
-            if chat_id:
-                conditions.append(Hit.chat_id == chat_id)
-            if chat_title:
-                conditions.append(Hit.chat_title == chat_title)
-            if start_time:
-                conditions.append(Hit.hit_at >= start_time)
-            if end_time:
-                conditions.append(Hit.hit_at <= end_time)
-            if min_amount is not None:
-                conditions.append(Hit.amount >= int(min_amount))
-            if exclude_bots:
-                # 排除任意包含 "bot" 的用户名（大小写不敏感）
-                conditions.append(not_(func.lower(Hit.username).like("%bot%")))
+        """
+        分页查询历史记录，按 (hit_at, id) 倒序。
+        传入 cursor 时使用游标分页（任意深度代价相同），返回结果中的 next/prev 为相邻页游标；
+        未传 cursor 时兼容旧的 page 偏移分页。
+        count_strategy 决定 total 的计算方式，结果中的 total_strategy/total_exact 说明其来源。
+        """
+        async with self.get_read_session() as session:
+            from sqlalchemy import select, and_, desc, asc, tuple_, literal
 
+            conditions = self._history_conditions(
+                username=username,
+                keyword=keyword,
+                chat_id=chat_id,
+                chat_title=chat_title,
+                start_time=start_time,
+                end_time=end_time,
+                min_amount=min_amount,
+                exclude_bots=exclude_bots,
+                username_q=username_q,
+                chat_title_q=chat_title_q,
+                fuzzy=fuzzy,
+                trgm_available=self.trgm_available,
+            )
             where_clause = and_(*conditions) if conditions else None
 
-            total_stmt = select(func.count(Hit.id))
-            if where_clause is not None:
-                total_stmt = total_stmt.where(where_clause)
-
-            total = (await session.execute(total_stmt)).scalar_one()
+            filters = {
+                "username": username,
+                "keyword": keyword,
+                "chat_id": chat_id,
+                "chat_title": chat_title,
+                "start_time": start_time,
+                "end_time": end_time,
+                "min_amount": min_amount,
+                "exclude_bots": exclude_bots,
+                "username_q": username_q,
+                "chat_title_q": chat_title_q,
+                "fuzzy": fuzzy,
+            }
+            total, total_strategy, total_exact = await self._count_hits(session, conditions, filters, count_strategy)
 
-            stmt = select(Hit).order_by(desc(Hit.hit_at)).offset((page - 1) * page_size).limit(page_size)
+            direction = "n"
+            # 额外带出原始 hit_at 用于生成游标
+            stmt = select(*history_columns(), Hit.hit_at.label("hit_at_raw"))
             if where_clause is not None:
                 stmt = stmt.where(where_clause)
+            if cursor:
+                direction, c_hit_at, c_id = decode_cursor(cursor)
+                key = tuple_(Hit.hit_at, Hit.id)
+                bound = tuple_(literal(c_hit_at, TIMESTAMP(timezone=False)), literal(c_id, Integer))
+                if direction == "n":
+                    stmt = stmt.where(key < bound)
+                else:
+                    stmt = stmt.where(key > bound)
+            if direction == "n":
+                stmt = stmt.order_by(desc(Hit.hit_at), desc(Hit.id))
+            else:
+                # 向前翻页：正序取紧邻的一页，再反转为倒序展示
+                stmt = stmt.order_by(asc(Hit.hit_at), asc(Hit.id))
+            if not cursor:
+                stmt = stmt.offset((page - 1) * page_size)
+            # 多取一条用于判断是否还有更多
+            stmt = stmt.limit(page_size + 1)
 
-            rows = (await session.execute(stmt)).scalars().all()
-
-            items = [
-                {
-                    "id": r.id,
-                    "username": r.username,
-                    "user_id": r.user_id,
-                    "keyword": r.keyword,
-                    "amount": r.amount,
-                    "chat_id": r.chat_id,
-                    "chat_title": r.chat_title,
-                    "hit_at": r.hit_at.isoformat(sep=" ", timespec="seconds"),
-                    "created_at": r.created_at.isoformat(sep=" ", timespec="seconds"),
-                }
-                for r in rows
-            ]
+            rows = list((await session.execute(stmt)).all())
+            has_more = len(rows) > page_size
+            rows = rows[:page_size]
+            if direction == "p":
+                rows.reverse()
 
-            return {"total": total, "page": page, "page_size": page_size, "items": items}
+            items = [dict(zip(HISTORY_FIELDS, r)) for r in rows]
 
-    async def query_stats(self, exclude_bots: bool = True) -> Dict[str, Any]:
-        async with self.get_session() as session:
-            from sqlalchemy import select, not_
+            # 从后一页向前翻回来时，后面必然还有记录；正向翻页时由 has_more 决定
+            has_next = has_more if direction == "n" else True
+            has_prev = has_more if direction == "p" else (cursor is not None or page > 1)
+            next_cursor = encode_cursor("n", rows[-1].hit_at_raw, rows[-1].id) if rows and has_next else None
+            prev_cursor = encode_cursor("p", rows[0].hit_at_raw, rows[0].id) if rows and has_prev else None
 
-            # 关键词统计
-            kw_stmt = select(Hit.keyword, func.count(Hit.id)).group_by(Hit.keyword)
+            return {
+                "total": total,
+                "total_strategy": total_strategy,
+                "total_exact": total_exact,
+                "page": page,
+                "page_size": page_size,
+                "items": items,
+                "next": next_cursor,
+                "prev": prev_cursor,
+            }
+
+    @staticmethod
+    def _bucket_range(model: Any, start_time: Optional[datetime], end_time: Optional[datetime]) -> List[Any]:
+        # 汇总表按小时粒度：起止时间按所在小时取整
+        conditions: List[Any] = []
+        if start_time:
+            conditions.append(model.bucket >= _hour_bucket(start_time))
+        if end_time:
+            conditions.append(model.bucket <= _hour_bucket(end_time))
+        return conditions
+
+    async def query_stats(
+        self,
+        exclude_bots: bool = True,
+        start_time: Optional[datetime] = None,
+        end_time: Optional[datetime] = None,
+        bucket_width: int = 1000,
+    ) -> Dict[str, Any]:
+        async with self.get_read_session() as session:
+            from sqlalchemy import select, not_, literal_column
+
+            # 关键词统计（读取小时汇总表）
+            kw_stmt = select(HitRollupChat.keyword, func.sum(HitRollupChat.hits)).where(
+                *self._bucket_range(HitRollupChat, start_time, end_time)
+            ).group_by(HitRollupChat.keyword)
             kw_rows = (await session.execute(kw_stmt)).all()
             keyword_counts = {k: int(c) for k, c in kw_rows}
 
             # 用户 TOP
-            user_stmt = select(Hit.username, func.count(Hit.id)).group_by(Hit.username).order_by(func.count(Hit.id).desc()).limit(20)
+            cnt = func.sum(HitRollupUser.hits)
+            user_stmt = select(HitRollupUser.username, cnt).where(
+                *self._bucket_range(HitRollupUser, start_time, end_time)
+            ).group_by(HitRollupUser.username).order_by(cnt.desc()).limit(20)
             if exclude_bots:
-                user_stmt = user_stmt.where(not_(func.lower(Hit.username).like("%bot%")))
+                user_stmt = user_stmt.where(not_(func.lower(HitRollupUser.username).like("%bot%")))
             user_rows = (await session.execute(user_stmt)).all()
             top_users = [{"username": u, "count": int(c)} for u, c in user_rows]
 
-            # 金额分布（按 1000 档）
-            bucket_stmt = select(((Hit.amount / 1000) * 1000).label("bucket"), func.count(Hit.id)).group_by("bucket").order_by("bucket")
+            # 金额分布（读取按日增量维护的直方图，默认按 1000 档合并）
+            width = amount_sketch.effective_width(bucket_width)
+            # 宽度以字面量内联，保证 SELECT 与 GROUP BY 中的表达式一致；基础档均为非负时整除即向下取整
+            w: ColumnElement[int] = literal_column(str(width), BigInteger)
+            merged = ((HitAmountHist.bucket // w) * w).label("bucket")
+            bucket_stmt = select(merged, func.sum(HitAmountHist.hits)).where(
+                *self._day_range(HitAmountHist, start_time, end_time)
+            ).group_by(merged).order_by(merged)
             bucket_rows = (await session.execute(bucket_stmt)).all()
             amount_buckets = [{"bucket": int(b), "count": int(c)} for b, c in bucket_rows]
 
+            percentiles = await self._amount_quantiles(session, start_time=start_time, end_time=end_time)
+
             return {
                 "keywords": keyword_counts,
                 "top_users": top_users,
                 "amount_buckets": amount_buckets,
+                "amount_percentiles": percentiles,
             }
 
-    async def query_group_unique_user_counts(self, exclude_bots: bool = True) -> List[Dict[str, Any]]:
-        async with self.get_session() as session:
+    @staticmethod
+    def _day_range(model: Any, start_time: Optional[datetime], end_time: Optional[datetime]) -> List[Any]:
+        # 金额直方图与草图按日粒度：起止时间按所在日取整
+        conditions: List[Any] = []
+        if start_time:
+            conditions.append(model.day >= _day_bucket(start_time))
+        if end_time:
+            conditions.append(model.day <= _day_bucket(end_time))
+        return conditions
+
+    async def _amount_quantiles(
+        self,
+        session: AsyncSession,
+        keyword: Optional[str] = None,
+        start_time: Optional[datetime] = None,
+        end_time: Optional[datetime] = None,
+    ) -> Dict[str, Optional[int]]:
+        from sqlalchemy import select
+
+        stmt = select(HitAmountSketch.bin, func.sum(HitAmountSketch.hits)).where(
+            *self._day_range(HitAmountSketch, start_time, end_time)
+        )
+        if keyword:
+            stmt = stmt.where(HitAmountSketch.keyword == keyword)
+        stmt = stmt.group_by(HitAmountSketch.bin)
+        rows = (await session.execute(stmt)).all()
+        return amount_sketch.quantiles([(int(i), int(c)) for i, c in rows])
+
+    async def query_amount_percentiles(
+        self,
+        start_time: Optional[datetime] = None,
+        end_time: Optional[datetime] = None,
+    ) -> Dict[str, Any]:
+        """
+        金额 p50/p90/p99：合并日期范围内（按日取整）各日的分位数草图，返回总体与各关键词的结果；
+        相对误差不超过 AMOUNT_SKETCH_ALPHA，不扫描 hits。
+        """
+        from sqlalchemy import select
+
+        async with self.get_read_session() as session:
+            stmt = select(HitAmountSketch.keyword, HitAmountSketch.bin, func.sum(HitAmountSketch.hits)).where(
+                *self._day_range(HitAmountSketch, start_time, end_time)
+            ).group_by(HitAmountSketch.keyword, HitAmountSketch.bin)
+            rows = (await session.execute(stmt)).all()
+        per_keyword: Dict[str, List[Tuple[int, int]]] = {}
+        overall: Dict[int, int] = {}
+        for kw, b, n in rows:
+            per_keyword.setdefault(kw, []).append((b, int(n)))
+            overall[b] = overall.get(b, 0) + int(n)
+        return {
+            "overall": amount_sketch.quantiles(overall.items()),
+            "keywords": {kw: amount_sketch.quantiles(bins) for kw, bins in sorted(per_keyword.items())},
+        }
+
+    async def query_group_unique_user_counts(
+        self,
+        exclude_bots: bool = True,
+        start_time: Optional[datetime] = None,
+        end_time: Optional[datetime] = None,
+        chat_ids: Optional[List[int]] = None,
+        exact: bool = False,
+    ) -> List[Dict[str, Any]]:
+        """
+        按群统计去重触发用户数。默认读取 Redis HyperLogLog（标准误差约 0.81%，时间范围按天取整），
+        exact=True、包含机器人或 HLL 尚未建立时回退为汇总表上的精确 COUNT(DISTINCT)。
+        """
+        if not exact and exclude_bots and self.unique_counter is not None:
+            try:
+                if await self.unique_counter.available():
+                    return await self._hll_group_unique_user_counts(start_time, end_time, chat_ids)
+            except Exception as e:
+                logger.warning("读取去重用户 HLL 失败，回退到精确统计：%s", e)
+        async with self.get_read_session() as session:
             from sqlalchemy import select, func, not_
 
-            stmt = select(
-                Hit.chat_id,
-                Hit.chat_title,
-                func.count(func.distinct(Hit.username))
-            ).where(Hit.chat_id.is_not(None), Hit.username.is_not(None))
+            uniq = func.count(func.distinct(HitRollupUser.username))
+            stmt = select(HitRollupUser.chat_id, uniq.label("unique_users")).where(
+                HitRollupUser.chat_id != 0,
+                *self._bucket_range(HitRollupUser, start_time, end_time),
+            )
+            if chat_ids is not None:
+                stmt = stmt.where(HitRollupUser.chat_id.in_(chat_ids))
             if exclude_bots:
-                stmt = stmt.where(not_(func.lower(Hit.username).like("%bot%")))
-            stmt = stmt.group_by(Hit.chat_id, Hit.chat_title).order_by(func.count(func.distinct(Hit.username)).desc())
+                stmt = stmt.where(not_(func.lower(HitRollupUser.username).like("%bot%")))
+            uniq_sub = stmt.group_by(HitRollupUser.chat_id).subquery()
 
-            rows = (await session.execute(stmt)).all()
+            # 群标题取汇总表中记录的标题（同一群改过名时取 max）
+            title_stmt = select(HitRollupChat.chat_id, func.max(HitRollupChat.chat_title).label("chat_title"))
+            if chat_ids is not None:
+                title_stmt = title_stmt.where(HitRollupChat.chat_id.in_(chat_ids))
+            title_sub = title_stmt.group_by(HitRollupChat.chat_id).subquery()
+
+            final = select(uniq_sub.c.chat_id, title_sub.c.chat_title, uniq_sub.c.unique_users).select_from(
+                uniq_sub.outerjoin(title_sub, title_sub.c.chat_id == uniq_sub.c.chat_id)
+            ).order_by(uniq_sub.c.unique_users.desc())
+
+            rows = (await session.execute(final)).all()
             return [
                 {"chat_id": int(cid) if cid is not None else None, "chat_title": title, "unique_users": int(cnt)}
                 for cid, title, cnt in rows
             ]
 
-    async def query_top_users_dual(self, limit: int = 50, exclude_bots: bool = True) -> Dict[str, List[Dict[str, Any]]]:
-        async with self.get_session() as session:
+    async def _hll_group_unique_user_counts(
+        self,
+        start_time: Optional[datetime],
+        end_time: Optional[datetime],
+        chat_ids: Optional[List[int]],
+    ) -> List[Dict[str, Any]]:
+        from sqlalchemy import select
+
+        assert self.unique_counter is not None
+        ids = list(chat_ids) if chat_ids is not None else await self.unique_counter.chat_ids()
+        counts = await self.unique_counter.counts(ids, start_time, end_time)
+        titles: Dict[int, Optional[str]] = {}
+        if ids:
+            async with self.get_read_session() as session:
+                title_stmt = select(HitRollupChat.chat_id, func.max(HitRollupChat.chat_title)).where(
+                    HitRollupChat.chat_id.in_(ids)
+                ).group_by(HitRollupChat.chat_id)
+                titles = {int(cid): title for cid, title in (await session.execute(title_stmt)).all()}
+        items: List[Dict[str, Any]] = [
+            {"chat_id": cid, "chat_title": titles.get(cid), "unique_users": n}
+            for cid, n in counts.items() if n > 0
+        ]
+        items.sort(key=lambda x: x["unique_users"], reverse=True)
+        return items
+
+    async def stream_chat_day_users(self, chunk_size: int = 10000) -> AsyncIterator[List[Tuple[int, datetime, str]]]:
+        """流式读取 hits 中去重的 (群, 日, 规范化用户名)，用于重建 HLL 计数器（维护任务，走无超时的维护引擎）。"""
+        from sqlalchemy import select, not_, literal_column
+
+        day = func.date_trunc(literal_column("'day'"), Hit.hit_at)
+        stmt = select(Hit.chat_id, day, Hit.username_lc).where(
+            Hit.chat_id.is_not(None),
+            Hit.chat_id != 0,
+            Hit.username_lc.is_not(None),
+            not_(Hit.is_bot),
+        ).group_by(Hit.chat_id, day, Hit.username_lc).execution_options(yield_per=chunk_size)
+        async with self.admin_engine.connect() as conn:
+            result = await conn.stream(stmt)
+            async for partition in result.partitions():
+                yield [(int(c), d, u) for c, d, u in partition]
+
+    async def query_top_users_dual(
+        self,
+        limit: int = 50,
+        exclude_bots: bool = True,
+        start_time: Optional[datetime] = None,
+        end_time: Optional[datetime] = None,
+    ) -> Dict[str, List[Dict[str, Any]]]:
+        async with self.get_read_session() as session:
             from sqlalchemy import select, func, not_
 
-            base = select(Hit.username, func.count(Hit.id).label("cnt"), func.sum(Hit.amount).label("sum_amt")).where(Hit.username.is_not(None))
+            cnt = func.sum(HitRollupUser.hits)
+            amt = func.sum(HitRollupUser.amount_sum)
+            base = select(HitRollupUser.username, cnt.label("cnt"), amt.label("sum_amt")).where(
+                *self._bucket_range(HitRollupUser, start_time, end_time)
+            )
             if exclude_bots:
-                base = base.where(not_(func.lower(Hit.username).like("%bot%")))
-            base = base.group_by(Hit.username)
+                base = base.where(not_(func.lower(HitRollupUser.username).like("%bot%")))
+            base = base.group_by(HitRollupUser.username)
 
-            rows_cnt = (await session.execute(base.order_by(func.count(Hit.id).desc()).limit(limit))).all()
-            rows_amt = (await session.execute(base.order_by(func.sum(Hit.amount).desc()).limit(limit))).all()
+            rows_cnt = (await session.execute(base.order_by(cnt.desc()).limit(limit))).all()
+            rows_amt = (await session.execute(base.order_by(amt.desc()).limit(limit))).all()
 
             return {
                 "by_count": [{"username": u, "count": int(c), "amount": int(a or 0)} for u, c, a in rows_cnt],
                 "by_amount": [{"username": u, "count": int(c), "amount": int(a or 0)} for u, c, a in rows_amt],
             }
 
+    async def query_user_rollup_totals(
+        self,
+        unit: str = "all",
+        since: Optional[datetime] = None,
+    ) -> List[Tuple[Optional[datetime], str, int, int]]:
+        """
+        按用户汇总笔数与金额（排除机器人），用于重建 Redis 排行榜。
+        unit 为 hour/day 时按对应粒度分桶，为 all 时不分桶（桶列为 None）。
+        """
+        from sqlalchemy import select, not_, null, literal_column
+
+        bucket: ColumnElement[Any]
+        if unit == "all":
+            bucket = null()
+        else:
+            # 粒度以字面量内联，保证 SELECT 与 GROUP BY 中的表达式一致
+            bucket = func.date_trunc(literal_column("'hour'" if unit == "hour" else "'day'"), HitRollupUser.bucket)
+        stmt = select(
+            bucket.label("b"),
+            HitRollupUser.username,
+            func.sum(HitRollupUser.hits),
+            func.sum(HitRollupUser.amount_sum),
+        ).where(not_(func.lower(HitRollupUser.username).like("%bot%")))
+        if since is not None:
+            stmt = stmt.where(HitRollupUser.bucket >= _hour_bucket(since))
+        stmt = stmt.group_by(bucket, HitRollupUser.username) if unit != "all" else stmt.group_by(HitRollupUser.username)
+        async with self.get_read_session() as session:
+            rows = (await session.execute(stmt)).all()
+        return [(b, u, int(h or 0), int(a or 0)) for b, u, h, a in rows]
+
     async def query_unique_usernames(
         self,
         username: Optional[str] = None,
@@ -300,78 +1205,170 @@ class Database:
         end_time: Optional[datetime] = None,
         min_amount: Optional[int] = None,
         exclude_bots: bool = True,
+        username_q: Optional[str] = None,
+        chat_title_q: Optional[str] = None,
+        fuzzy: bool = False,
     ) -> List[str]:
-        async with self.get_session() as session:
-            from sqlalchemy import select, and_, not_, func
-
-            from typing import Any as _Any
-            conditions: List[_Any] = [Hit.username.is_not(None)]
-            if username:
-                conditions.append(Hit.username == username)
-            if keyword:
-                conditions.append(Hit.keyword == keyword)
-            if chat_id:
-                conditions.append(Hit.chat_id == chat_id)
-            if chat_title:
-                conditions.append(Hit.chat_title == chat_title)
-            if start_time:
-                conditions.append(Hit.hit_at >= start_time)
-            if end_time:
-                conditions.append(Hit.hit_at <= end_time)
-            if min_amount is not None:
-                conditions.append(Hit.amount >= int(min_amount))
-            if exclude_bots:
-                conditions.append(not_(func.lower(Hit.username).like("%bot%")))
+        async with self.get_read_session() as session:
+            from sqlalchemy import select, and_
+
+            conditions: List[Any] = [Hit.username.is_not(None)]
+            conditions += self._history_conditions(
+                username=username,
+                keyword=keyword,
+                chat_id=chat_id,
+                chat_title=chat_title,
+                start_time=start_time,
+                end_time=end_time,
+                min_amount=min_amount,
+                exclude_bots=exclude_bots,
+                username_q=username_q,
+                chat_title_q=chat_title_q,
+                fuzzy=fuzzy,
+                trgm_available=self.trgm_available,
+            )
 
             where_clause = and_(*conditions)
             stmt = select(func.distinct(Hit.username)).where(where_clause)
             rows = (await session.execute(stmt)).all()
             return [r[0] for r in rows if r[0]]
 
-    async def query_all_groups_stats(self, exclude_bots: bool = True) -> List[Dict[str, Any]]:
-        """获取所有监听群组的统计数据，包括群名、去重转发数、更新时间"""
-        async with self.get_session() as session:
-            from sqlalchemy import select, func, not_, outerjoin, desc
-
-            # 获取所有群组的去重触发用户数
-            uniq_counts = await self.query_group_unique_user_counts(exclude_bots=exclude_bots)
-            uniq_map = {row["chat_id"]: row for row in uniq_counts}
-
-            # 获取所有群组信息
-            stmt = select(Group).order_by(desc(Group.updated_at))
-            groups = (await session.execute(stmt)).scalars().all()
-
-            # 合并数据
-            result = []
-            for group in groups:
-                uniq_data = uniq_map.get(group.id, {})
-                result.append({
-                    "id": group.id,
-                    "title": group.title or uniq_data.get("chat_title", "-"),
-                    "username": group.username,
-                    "is_megagroup": group.is_megagroup,
-                    "is_broadcast": group.is_broadcast,
-                    "unique_users": uniq_data.get("unique_users", 0),
-                    "updated_at": group.updated_at.isoformat(sep=" ", timespec="seconds") if group.updated_at else None,
-                    "created_at": group.created_at.isoformat(sep=" ", timespec="seconds") if group.created_at else None,
-                })
-
-            # 添加在Hit表中有记录但不在Group表中的群组
-            for chat_id, uniq_data in uniq_map.items():
-                if not any(g["id"] == chat_id for g in result):
-                    result.append({
-                        "id": chat_id,
-                        "title": uniq_data.get("chat_title", "-"),
-                        "username": None,
-                        "is_megagroup": None,
-                        "is_broadcast": None,
-                        "unique_users": uniq_data.get("unique_users", 0),
-                        "updated_at": None,
-                        "created_at": None,
-                    })
-
-            # 按去重转发数排序
-            result.sort(key=lambda x: x["unique_users"], reverse=True)
-            return result
+    async def stream_history(
+        self,
+        chunk_size: int = 2000,
+        **filters: Any,
+    ) -> AsyncIterator[List[Tuple[Any, ...]]]:
+        """
+        以服务端游标流式读取符合筛选条件的全部命中记录（按 (hit_at, id) 倒序），每次产出至多 chunk_size 行元组；
+        不设行数上限，内存占用与结果集大小无关。筛选参数同 _history_conditions。
+        """
+        from sqlalchemy import select, and_, desc
+
+        conditions = self._history_conditions(trgm_available=self.trgm_available, **filters)
+        stmt = select(*history_columns())
+        if conditions:
+            stmt = stmt.where(and_(*conditions))
+        stmt = stmt.order_by(desc(Hit.hit_at), desc(Hit.id)).execution_options(yield_per=chunk_size)
+        async with self.get_read_session() as session:
+            result = await session.stream(stmt)
+            async for partition in result.partitions():
+                yield [tuple(r) for r in partition]
+
+    async def stream_unique_usernames(
+        self,
+        chunk_size: int = 2000,
+        **filters: Any,
+    ) -> AsyncIterator[List[str]]:
+        """流式读取去重用户名，语义同 query_unique_usernames。"""
+        from sqlalchemy import select, and_
+
+        conditions: List[Any] = [Hit.username.is_not(None)]
+        conditions += self._history_conditions(trgm_available=self.trgm_available, **filters)
+        stmt = select(func.distinct(Hit.username)).where(and_(*conditions)).execution_options(yield_per=chunk_size)
+        async with self.get_read_session() as session:
+            result = await session.stream(stmt)
+            async for partition in result.partitions():
+                yield [r[0] for r in partition if r[0]]
 
+    def _groups_stats_select(
+        self,
+        q: Optional[str] = None,
+        group_type: Optional[str] = None,
+        exclude_bots: bool = True,
+        fuzzy: bool = False,
+    ) -> Any:
+        """
+        群组统计查询：groups 与按群聚合的去重用户数做全外连接，
+        既包含目录中的群，也包含只在命中记录中出现过的群；搜索与类型筛选均在 SQL 内完成。
+        """
+        from sqlalchemy import select, not_, or_, and_, literal
+
+        uniq_stmt = select(
+            HitRollupUser.chat_id.label("chat_id"),
+            func.count(func.distinct(HitRollupUser.username)).label("unique_users"),
+        ).where(HitRollupUser.chat_id != 0)
+        if exclude_bots:
+            uniq_stmt = uniq_stmt.where(not_(func.lower(HitRollupUser.username).like("%bot%")))
+        agg = uniq_stmt.group_by(HitRollupUser.chat_id).subquery("agg")
 
+        titles = select(
+            HitRollupChat.chat_id.label("chat_id"),
+            func.max(HitRollupChat.chat_title).label("chat_title"),
+        ).where(HitRollupChat.chat_id != 0).group_by(HitRollupChat.chat_id).subquery("titles")
+
+        gid = func.coalesce(Group.id, agg.c.chat_id)
+        title = func.coalesce(Group.title, titles.c.chat_title, literal("-"))
+        unique_users = func.coalesce(agg.c.unique_users, 0)
+        stmt = select(
+            gid.label("id"),
+            title.label("title"),
+            Group.username,
+            Group.is_megagroup,
+            Group.is_broadcast,
+            unique_users.label("unique_users"),
+            ts_text(Group.updated_at, "updated_at"),
+            ts_text(Group.created_at, "created_at"),
+        ).select_from(
+            Group.__table__.outerjoin(agg, agg.c.chat_id == Group.id, full=True).outerjoin(
+                titles, titles.c.chat_id == gid
+            )
+        )
+        if q:
+            # 分别匹配各列（而非 coalesce 表达式），以便命中三元组索引
+            stmt = stmt.where(or_(
+                text_search(Group.title, q, fuzzy, self.trgm_available),
+                text_search(Group.username, q, fuzzy, self.trgm_available),
+                and_(Group.id.is_(None), text_search(titles.c.chat_title, q, fuzzy, self.trgm_available)),
+            ))
+        if group_type == "megagroup":
+            stmt = stmt.where(Group.is_megagroup.is_(True))
+        elif group_type == "broadcast":
+            stmt = stmt.where(Group.is_broadcast.is_(True))
+        return stmt.order_by(unique_users.desc(), gid)
+
+    @staticmethod
+    def _group_stats_row(r: Any) -> Dict[str, Any]:
+        return {
+            "id": int(r.id),
+            "title": r.title,
+            "username": r.username,
+            "is_megagroup": r.is_megagroup,
+            "is_broadcast": r.is_broadcast,
+            "unique_users": int(r.unique_users or 0),
+            "updated_at": r.updated_at,
+            "created_at": r.created_at,
+        }
+
+    async def query_groups_stats_page(
+        self,
+        page: int = 1,
+        page_size: int = 50,
+        q: Optional[str] = None,
+        group_type: Optional[str] = None,
+        exclude_bots: bool = True,
+        fuzzy: bool = False,
+    ) -> Dict[str, Any]:
+        """分页获取群组统计：筛选、按去重用户数排序与分页均在单条 SQL 中完成。"""
+        async with self.get_read_session() as session:
+            from sqlalchemy import select
+
+            base = self._groups_stats_select(q=q, group_type=group_type, exclude_bots=exclude_bots, fuzzy=fuzzy)
+            # 窗口函数一次性带出筛选后的总数
+            paged = base.add_columns(func.count().over().label("total_count")).offset((page - 1) * page_size).limit(page_size)
+            rows = (await session.execute(paged)).all()
+            if rows:
+                total = int(rows[0].total_count)
+            else:
+                total = int((await session.execute(select(func.count()).select_from(base.subquery()))).scalar_one())
+            return {
+                "total": total,
+                "page": page,
+                "page_size": page_size,
+                "items": [self._group_stats_row(r) for r in rows],
+            }
+
+    async def query_all_groups_stats(self, exclude_bots: bool = True) -> List[Dict[str, Any]]:
+        """获取所有监听群组的统计数据，包括群名、去重转发数、更新时间"""
+        async with self.get_read_session() as session:
+            rows = (await session.execute(self._groups_stats_select(exclude_bots=exclude_bots))).all()
+            return [self._group_stats_row(r) for r in rows]
@@ -0,0 +1,95 @@
+from __future__ import annotations
+
+import statistics
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Optional, Type
+
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+
+class PoolMetrics:
+    """连接池取连接的等待耗时统计（毫秒）。"""
+
+    def __init__(self) -> None:
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total_ms = 0.0
+        self.wait_max_ms = 0.0
+        self._samples: Deque[float] = deque(maxlen=1000)
+
+    def record(self, wait_ms: float, timed_out: bool = False) -> None:
+        if timed_out:
+            self.timeouts += 1
+            return
+        self.checkouts += 1
+        self.wait_total_ms += wait_ms
+        self.wait_max_ms = max(self.wait_max_ms, wait_ms)
+        self._samples.append(wait_ms)
+
+    def stats(self) -> Dict[str, Any]:
+        samples = sorted(self._samples)
+        return {
+            "checkouts": self.checkouts,
+            "timeouts": self.timeouts,
+            "wait_avg_ms": round(self.wait_total_ms / self.checkouts, 2) if self.checkouts else None,
+            "wait_p50_ms": round(statistics.median(samples), 2) if samples else None,
+            "wait_p95_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 2) if samples else None,
+            "wait_max_ms": round(self.wait_max_ms, 2),
+        }
+
+
+class _TimedQueuePool(AsyncAdaptedQueuePool):
+    metrics: PoolMetrics
+
+    def _do_get(self) -> Any:
+        started = time.perf_counter()
+        try:
+            conn = super()._do_get()
+        except Exception as e:
+            from sqlalchemy.exc import TimeoutError as PoolTimeout
+
+            if isinstance(e, PoolTimeout):
+                self.metrics.record(0.0, timed_out=True)
+            raise
+        self.metrics.record((time.perf_counter() - started) * 1000)
+        return conn
+
+
+def timed_pool_class(name: str) -> Type[_TimedQueuePool]:
+    """为每个引擎生成独立的连接池子类，统计挂在类上，pool.recreate() 后依然保留。"""
+    return type(f"{name.title()}TimedQueuePool", (_TimedQueuePool,), {"metrics": PoolMetrics()})
+
+
+def engine_options(
+    name: str,
+    pool_size: int,
+    max_overflow: int,
+    pool_timeout: float,
+    statement_timeout_ms: Optional[int],
+) -> Dict[str, Any]:
+    """create_async_engine 的连接池参数；statement_timeout 通过 asyncpg 的 server_settings 在每个连接上生效。"""
+    options: Dict[str, Any] = {
+        "poolclass": timed_pool_class(name),
+        "pool_size": pool_size,
+        "max_overflow": max_overflow,
+        "pool_timeout": pool_timeout,
+        "pool_pre_ping": True,
+    }
+    if statement_timeout_ms:
+        options["connect_args"] = {"server_settings": {"statement_timeout": str(statement_timeout_ms)}}
+    return options
+
+
+def pool_stats(engine: Any) -> Dict[str, Any]:
+    pool = engine.pool
+    data: Dict[str, Any] = {}
+    if isinstance(pool, _TimedQueuePool):
+        data.update(
+            size=pool.size(),
+            checked_out=pool.checkedout(),
+            overflow=pool.overflow(),
+            idle=pool.checkedin(),
+        )
+        data.update(pool.metrics.stats())
+    return data
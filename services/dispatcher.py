@@ -0,0 +1,182 @@
+from __future__ import annotations
+
+import asyncio
+import itertools
+import logging
+import statistics
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Deque, Dict, Optional
+
+
+logger = logging.getLogger(__name__)
+
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+
+
+class TokenBucket:
+    """令牌桶：rate 为每秒补充的令牌数，capacity 为允许的突发上限。"""
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self) -> float:
+        """距离下一个可用令牌还需等待的秒数，0 表示当前即可发送。"""
+        self._refill()
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self) -> None:
+        self.tokens -= 1
+
+
+@dataclass(order=True)
+class _SendJob:
+    priority: int
+    seq: int
+    chat_id: int = field(compare=False)
+    text: str = field(compare=False)
+    kwargs: Dict[str, Any] = field(compare=False)
+    future: "asyncio.Future[Any]" = field(compare=False)
+    enqueued_at: float = field(compare=False)
+
+
+class SendDispatcher:
+    """
+    Bot 消息发送调度器：所有 send_message 经由单一队列按优先级出队，
+    同时受全局与单个目标会话两级令牌桶限速；遇到 TelegramRetryAfter 时暂停 retry_after 秒后重试，
+    不会中断后续消息。大额告警走高优先级通道。
+    """
+
+    def __init__(
+        self,
+        bot,
+        global_rate: float = 25.0,
+        chat_rate_per_minute: float = 20.0,
+        chat_burst: float = 5.0,
+        max_retries: int = 5,
+    ) -> None:
+        self.bot = bot
+        self.global_bucket = TokenBucket(global_rate, max(1.0, global_rate))
+        self.chat_rate = chat_rate_per_minute / 60.0
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._chat_buckets: Dict[int, TokenBucket] = {}
+        self._queue: "asyncio.PriorityQueue[_SendJob]" = asyncio.PriorityQueue()
+        self._seq = itertools.count()
+        self._task: Optional[asyncio.Task] = None
+        self._wait_ms: Deque[float] = deque(maxlen=1000)
+        self.sent = 0
+        self.failed = 0
+        self.throttled = 0
+        self.retry_after_events = 0
+        self.retry_after_seconds = 0.0
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name="send-dispatcher")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        # 未发送的任务直接取消，调用方按失败处理
+        while not self._queue.empty():
+            job = self._queue.get_nowait()
+            if not job.future.done():
+                job.future.cancel()
+
+    async def send(self, chat_id: int, text: str, priority: int = PRIORITY_NORMAL, **kwargs: Any) -> Any:
+        """排队发送一条消息并等待结果；返回 Bot API 的 Message。"""
+        future: "asyncio.Future[Any]" = asyncio.get_running_loop().create_future()
+        job = _SendJob(
+            priority=priority,
+            seq=next(self._seq),
+            chat_id=chat_id,
+            text=text,
+            kwargs=kwargs,
+            future=future,
+            enqueued_at=time.monotonic(),
+        )
+        await self._queue.put(job)
+        return await future
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    async def _run(self) -> None:
+        while True:
+            job = await self._queue.get()
+            if job.future.done():
+                continue
+            try:
+                result = await self._deliver(job)
+            except asyncio.CancelledError:
+                if not job.future.done():
+                    job.future.cancel()
+                raise
+            except Exception as e:
+                self.failed += 1
+                if not job.future.done():
+                    job.future.set_exception(e)
+                continue
+            self.sent += 1
+            if not job.future.done():
+                job.future.set_result(result)
+
+    async def _deliver(self, job: _SendJob) -> Any:
+        from aiogram.exceptions import TelegramRetryAfter
+
+        chat_bucket = self._chat_bucket(job.chat_id)
+        attempt = 0
+        while True:
+            wait = max(self.global_bucket.delay(), chat_bucket.delay())
+            if wait > 0:
+                self.throttled += 1
+                await asyncio.sleep(wait)
+                continue
+            self.global_bucket.consume()
+            chat_bucket.consume()
+            if attempt == 0:
+                self._wait_ms.append((time.monotonic() - job.enqueued_at) * 1000)
+            try:
+                return await self.bot.send_message(chat_id=job.chat_id, text=job.text, **job.kwargs)
+            except TelegramRetryAfter as e:
+                attempt += 1
+                self.retry_after_events += 1
+                self.retry_after_seconds += float(e.retry_after)
+                if attempt > self.max_retries:
+                    raise
+                logger.warning("触发 Telegram 限流，%s 秒后重试（第 %s 次）", e.retry_after, attempt)
+                # 限流期间整条队列暂停，避免继续撞限
+                await asyncio.sleep(float(e.retry_after))
+
+    def stats(self) -> Dict[str, Any]:
+        samples = list(self._wait_ms)
+        return {
+            "queued": self._queue.qsize(),
+            "sent": self.sent,
+            "failed": self.failed,
+            "throttled": self.throttled,
+            "retry_after_events": self.retry_after_events,
+            "retry_after_seconds": round(self.retry_after_seconds, 1),
+            "wait_p50_ms": round(statistics.median(samples), 1) if samples else None,
+            "wait_max_ms": round(max(samples), 1) if samples else None,
+        }
@@ -0,0 +1,97 @@
+from __future__ import annotations
+
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, Optional, Tuple
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class EntityFacts:
+    """仅保留过滤所需的实体信息，避免缓存完整的 Telethon 实体对象。"""
+
+    is_bot: bool
+    username: str  # 小写，不带 @；无用户名时为空字符串
+
+
+# 负缓存哨兵：实体无法解析时同样缓存，避免转发风暴中反复请求
+_UNRESOLVED = EntityFacts(is_bot=False, username="")
+
+
+class EntityFactsCache:
+    """
+    进程级 LRU + TTL 实体缓存，以 peer id 为键，所有 Telethon 客户端共享。
+    用于转发消息来源判定，命中时不再调用 get_entity。
+    """
+
+    def __init__(self, max_size: int = 50000, ttl_seconds: int = 6 * 3600, negative_ttl_seconds: int = 600) -> None:
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.negative_ttl_seconds = negative_ttl_seconds
+        self._items: "OrderedDict[int, Tuple[EntityFacts, float]]" = OrderedDict()
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, peer_id: int) -> Optional[EntityFacts]:
+        entry = self._items.get(peer_id)
+        if entry is None:
+            return None
+        facts, expires_at = entry
+        if time.monotonic() >= expires_at:
+            del self._items[peer_id]
+            return None
+        self._items.move_to_end(peer_id)
+        return facts
+
+    def put(self, peer_id: int, facts: Optional[EntityFacts]) -> None:
+        ttl = self.ttl_seconds if facts is not None else self.negative_ttl_seconds
+        self._items[peer_id] = (facts if facts is not None else _UNRESOLVED, time.monotonic() + ttl)
+        self._items.move_to_end(peer_id)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+            self.evictions += 1
+
+    async def resolve(self, client: Any, peer: Any) -> Optional[EntityFacts]:
+        """返回实体信息；无法解析时返回 None（结果同样会被缓存）。"""
+        from telethon.utils import get_peer_id
+
+        peer_id = get_peer_id(peer)
+        cached = self.get(peer_id)
+        if cached is not None:
+            if cached is _UNRESOLVED:
+                self.negative_hits += 1
+                return None
+            self.hits += 1
+            return cached
+
+        self.misses += 1
+        try:
+            entity = await client.get_entity(peer)
+        except Exception as e:
+            logger.debug("实体解析失败 %s：%s", peer_id, e)
+            self.put(peer_id, None)
+            return None
+        facts = EntityFacts(
+            is_bot=bool(getattr(entity, "bot", False)),
+            username=str(getattr(entity, "username", "") or "").lower(),
+        )
+        self.put(peer_id, facts)
+        return facts
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.negative_hits + self.misses
+        return {
+            "size": len(self._items),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": round((self.hits + self.negative_hits) / lookups, 4) if lookups else 0.0,
+        }
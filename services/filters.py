@@ -13,6 +13,8 @@ KEYWORDS = ["大单", "大双", "小单", "小双", "大", "小", "单", "双"]
 # - 纯数字 >= 3 位，例如 300、12345
 # - 或者带标准千分位分隔：1,000、12,345、1,234,567
 NUM = r"(?:[1-9]\d{2,}|\d{1,3}(?:,\d{3})+)"
+# hits.amount 为 int4，超出上限的金额视为无效（否则该命中永远无法入库）
+MAX_AMOUNT = 2_147_483_647
 PATTERN = re.compile(rf"(大单|大双|小单|小双|大|小|单|双)\s*({NUM})")
 
 
@@ -26,7 +28,7 @@ class MatchResult:
 def parse_message(text: str) -> Optional[MatchResult]:
     """
     从文本中匹配关键词+金额，若有多个匹配取金额最大的；若金额相同取最早出现的。
-    仅当金额 >= 300 时有效。
+    仅当 300 <= 金额 <= MAX_AMOUNT 时有效。
     """
     if not text:
         return None
@@ -36,7 +38,7 @@ def parse_message(text: str) -> Optional[MatchResult]:
         kw = m.group(1)
         raw_num = m.group(2)
         normalized = int(raw_num.replace(",", ""))
-        if normalized < 300:
+        if normalized < 300 or normalized > MAX_AMOUNT:
             continue
         candidates.append((normalized, m.start(), kw, raw_num))
 
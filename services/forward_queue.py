@@ -0,0 +1,182 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+import socket
+from typing import Any, Dict, List, Optional, Tuple
+
+
+logger = logging.getLogger(__name__)
+
+
+FORWARD_QUEUE_KEY = "wd:fwd:q"
+FORWARD_STREAM_KEY = "wd:fwd:stream"
+FORWARD_STREAM_GROUP = "forwarders"
+
+# 队列条目：(条目 id, 载荷)；列表模式下条目 id 为 None
+QueueItem = Tuple[Optional[str], Dict[str, Any]]
+
+
+class ListForwardQueue:
+    """
+    基于 Redis 列表的转发队列（RPUSH/BLPOP），弹出即删除。正常停止时未处理的条目经 requeue 放回队首；
+    进程崩溃时已弹出未处理的条目会丢失（需要不丢消息时使用 stream 模式）。
+    """
+
+    mode = "list"
+
+    def __init__(self, redis_client, key: str = FORWARD_QUEUE_KEY) -> None:
+        self.redis = redis_client
+        self.key = key
+
+    async def setup(self) -> None:
+        return None
+
+    async def push(self, payload: Dict[str, Any]) -> None:
+        await self.redis.client.rpush(self.key, json.dumps(payload))
+
+    async def pop_batch(self, count: int, block_ms: Optional[int] = None) -> List[QueueItem]:
+        items: List[QueueItem] = []
+        raws: List[str] = []
+        if block_ms:
+            # 队列为空时阻塞等待首条（BLPOP 超时单位为秒），其余非阻塞取出
+            resp = await self.redis.client.blpop([self.key], timeout=block_ms / 1000)
+            if not resp:
+                return items
+            raws.append(resp[1])
+        for _ in range(count - len(raws)):
+            raw = await self.redis.client.lpop(self.key)
+            if not raw:
+                break
+            raws.append(raw)
+        for raw in raws:
+            try:
+                items.append((None, json.loads(raw)))
+            except Exception:
+                continue
+        return items
+
+    async def ack(self, entry_id: Optional[str]) -> None:
+        return None
+
+    async def requeue(self, items: List[QueueItem]) -> None:
+        """将已弹出但未处理的条目按原顺序放回队首。"""
+        if not items:
+            return
+        await self.redis.client.lpush(self.key, *[json.dumps(data) for _, data in reversed(items)])
+
+    async def stats(self) -> Dict[str, Any]:
+        return {"mode": self.mode, "length": int(await self.redis.client.llen(self.key))}
+
+
+class StreamForwardQueue:
+    """
+    基于 Redis Streams 的转发队列：XADD 入队，消费者组 XREADGROUP 读取，处理完成后 XACK。
+    进程在读取与确认之间退出时，条目留在待确认列表中，由其他消费者通过 XAUTOCLAIM 接管，
+    因此可以并行运行多个转发进程而不丢消息。
+    """
+
+    mode = "stream"
+
+    def __init__(
+        self,
+        redis_client,
+        key: str = FORWARD_STREAM_KEY,
+        group: str = FORWARD_STREAM_GROUP,
+        consumer: Optional[str] = None,
+        maxlen: int = 100000,
+        claim_idle_ms: int = 60000,
+    ) -> None:
+        self.redis = redis_client
+        self.key = key
+        self.group = group
+        self.consumer = consumer or f"{socket.gethostname()}-{os.getpid()}"
+        self.maxlen = maxlen
+        self.claim_idle_ms = claim_idle_ms
+        self._claim_cursor = "0-0"
+
+    async def setup(self) -> None:
+        try:
+            await self.redis.client.xgroup_create(self.key, self.group, id="0", mkstream=True)
+            logger.info("已创建转发队列消费者组：%s/%s", self.key, self.group)
+        except Exception as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    async def push(self, payload: Dict[str, Any]) -> None:
+        await self.redis.client.xadd(
+            self.key, {"data": json.dumps(payload)}, maxlen=self.maxlen, approximate=True
+        )
+
+    async def pop_batch(self, count: int, block_ms: Optional[int] = None) -> List[QueueItem]:
+        # 优先接管超时未确认的条目，再读取新条目
+        entries = await self._reclaim(count)
+        if len(entries) < count:
+            resp = await self.redis.client.xreadgroup(
+                self.group, self.consumer, {self.key: ">"}, count=count - len(entries), block=block_ms
+            )
+            for _stream, stream_entries in resp or []:
+                entries.extend(stream_entries)
+        items: List[QueueItem] = []
+        for entry_id, fields in entries:
+            try:
+                items.append((entry_id, json.loads(fields["data"])))
+            except Exception:
+                # 无法解析的条目直接确认丢弃，避免反复被接管
+                await self.ack(entry_id)
+        return items
+
+    async def _reclaim(self, count: int) -> List[Any]:
+        try:
+            resp = await self.redis.client.xautoclaim(
+                self.key, self.group, self.consumer, self.claim_idle_ms, start_id=self._claim_cursor, count=count
+            )
+        except Exception as e:
+            logger.debug("XAUTOCLAIM 失败：%s", e)
+            return []
+        self._claim_cursor = resp[0] or "0-0"
+        # 已被裁剪的条目字段为空，跳过
+        return [(entry_id, fields) for entry_id, fields in resp[1] if fields]
+
+    async def ack(self, entry_id: Optional[str]) -> None:
+        if entry_id is None:
+            return
+        await self.redis.client.xack(self.key, self.group, entry_id)
+
+    async def requeue(self, items: List[QueueItem]) -> None:
+        # 未确认的条目仍在待确认列表中，空闲超时后会被 XAUTOCLAIM 接管，无需放回
+        return None
+
+    async def stats(self) -> Dict[str, Any]:
+        length = int(await self.redis.client.xlen(self.key))
+        pending = 0
+        lag: Optional[int] = None
+        consumers = 0
+        try:
+            for g in await self.redis.client.xinfo_groups(self.key):
+                if g.get("name") == self.group:
+                    pending = int(g.get("pending") or 0)
+                    consumers = int(g.get("consumers") or 0)
+                    # lag 字段需 Redis 7+
+                    lag = int(g["lag"]) if g.get("lag") is not None else None
+        except Exception:
+            pass
+        return {
+            "mode": self.mode,
+            "length": length,
+            "pending": pending,
+            "lag": lag,
+            "consumers": consumers,
+        }
+
+
+def build_forward_queue(redis_client, mode: Optional[str] = None):
+    mode = (mode or os.getenv("FORWARD_QUEUE_MODE") or "list").strip().lower()
+    if mode == "stream":
+        return StreamForwardQueue(
+            redis_client,
+            maxlen=int(os.getenv("FORWARD_STREAM_MAXLEN", "100000") or 100000),
+            claim_idle_ms=int(os.getenv("FORWARD_STREAM_CLAIM_IDLE_MS", "60000") or 60000),
+        )
+    return ListForwardQueue(redis_client)
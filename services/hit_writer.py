@@ -0,0 +1,179 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from sqlalchemy.exc import DisconnectionError, InterfaceError, OperationalError, TimeoutError as PoolTimeout
+
+
+logger = logging.getLogger(__name__)
+
+
+# 落库成功后的回调（如确认队列条目）
+OnPersisted = Callable[[], Awaitable[Any]]
+# 缓冲条目：(命中行, 落库后回调, 去重键)
+BufferItem = Tuple[Dict[str, Any], Optional[OnPersisted], Optional[str]]
+
+
+def is_transient_error(e: BaseException) -> bool:
+    """连接/超时类错误：整批保留重试；其余（如数据越界、约束冲突）视为行数据问题。"""
+    if isinstance(e, (OperationalError, InterfaceError, DisconnectionError, PoolTimeout, OSError, asyncio.TimeoutError)):
+        return True
+    return bool(getattr(e, "connection_invalidated", False))
+
+
+class HitBatcher:
+    """
+    命中记录写后缓冲：转发路径只把记录放入内存缓冲，由后台任务按数量或时间阈值
+    以一次多行 INSERT 批量落库。缓冲仅在内存中，退出时需调用 close() 刷盘；
+    调用方可传入 on_persisted，在所在批次写入成功后才执行（如确认队列条目），未落库的条目不会被提前确认。
+    缓冲达到 max_buffer 条时 add() 等待刷盘腾出空间，向上游施加背压。
+    整批写入因连接/超时失败时保留重试；因数据错误失败时逐行重写，仍失败的行记录日志后丢弃，避免一行坏数据阻塞全部写入。
+    """
+
+    def __init__(self, db, max_batch: int = 200, max_delay: float = 0.5, max_buffer: int = 10000) -> None:
+        self.db = db
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.max_buffer = max(max_batch, max_buffer)
+        self._buffer: List[BufferItem] = []
+        # 已在缓冲中（尚未落库或丢弃）的去重键，避免同一队列条目被重新接管后重复入缓冲
+        self._keys: Set[str] = set()
+        self._lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._drained = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+        self.flushed_rows = 0
+        self.flushes = 0
+        self.failed_rows = 0
+        self.dropped_rows = 0
+        self.duplicate_adds = 0
+        self.backpressure_waits = 0
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name="hit-batcher")
+
+    async def add(self, data: Dict[str, Any], on_persisted: Optional[OnPersisted] = None, key: Optional[str] = None) -> None:
+        """key 非空时同一 key 在落库前只缓冲一次（重复添加直接忽略，由首次添加的回调负责确认）。"""
+        if key is not None and key in self._keys:
+            self.duplicate_adds += 1
+            return
+        if self._task is not None and len(self._buffer) >= self.max_buffer:
+            self.backpressure_waits += 1
+            while len(self._buffer) >= self.max_buffer:
+                self._drained.clear()
+                self._wakeup.set()
+                await self._drained.wait()
+            if key is not None and key in self._keys:
+                self.duplicate_adds += 1
+                return
+        self._buffer.append((data, on_persisted, key))
+        if key is not None:
+            self._keys.add(key)
+        if len(self._buffer) >= self.max_batch:
+            self._wakeup.set()
+        if self._task is None:
+            # 未启动后台任务时（如脚本场景）退化为同步写入
+            await self.flush()
+
+    async def _run(self) -> None:
+        # 除取消外也检查关闭标志：wait_for 在超时与取消同时发生时可能吞掉取消
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.max_delay)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.exception("命中记录批量写入失败：%s", e)
+                # 数据库不可用时避免被背压唤醒后立即重试
+                await asyncio.sleep(self.max_delay)
+
+    async def flush(self) -> int:
+        async with self._lock:
+            written = 0
+            try:
+                while self._buffer:
+                    batch = self._buffer[: self.max_batch]
+                    try:
+                        await self.db.insert_hits([row for row, _, _ in batch])
+                    except Exception as e:
+                        self.failed_rows += len(batch)
+                        if is_transient_error(e):
+                            # 连接/超时错误：整批留在缓冲头部，下次重试
+                            raise
+                        logger.warning("命中记录批量写入失败（%s），改为逐行写入：%s", len(batch), e)
+                        written += await self._insert_rows_one_by_one(batch)
+                        continue
+                    # 写入成功后才移出缓冲：写入途中被取消时整批仍在缓冲中
+                    del self._buffer[: len(batch)]
+                    written += len(batch)
+                    self.flushes += 1
+                    await self._finish(batch)
+            finally:
+                self.flushed_rows += written
+                self._drained.set()
+            return written
+
+    async def _insert_rows_one_by_one(self, batch: List[BufferItem]) -> int:
+        """逐行写入批次（已位于缓冲头部）；数据错误的行丢弃，遇到连接/超时错误时剩余行留在缓冲中并抛出。"""
+        written = 0
+        for item in batch:
+            try:
+                await self.db.insert_hits([item[0]])
+            except Exception as e:
+                if is_transient_error(e):
+                    raise
+                self.dropped_rows += 1
+                logger.error("命中记录无法写入，已丢弃：%r：%s", item[0], e)
+            else:
+                written += 1
+            # 已写入或已丢弃的行都视为处理完毕（丢弃的条目也需确认，否则会被反复重新投递）
+            del self._buffer[0]
+            await self._finish([item])
+        return written
+
+    async def _finish(self, batch: List[BufferItem]) -> None:
+        for _, cb, key in batch:
+            if key is not None:
+                self._keys.discard(key)
+            if cb is None:
+                continue
+            try:
+                await cb()
+            except Exception as e:
+                logger.warning("命中记录落库后回调失败：%s", e)
+
+    async def close(self) -> None:
+        if self._task is not None:
+            # 不取消后台任务：让进行中的写入完成，循环检查到关闭标志后退出
+            self._closing = True
+            self._wakeup.set()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        started = time.monotonic()
+        try:
+            written = await self.flush()
+        except Exception as e:
+            # 未落库的条目不会被确认，Streams 模式下重启后会重新投递
+            logger.exception("退出前刷写命中记录失败，丢弃 %s 条：%s", len(self._buffer), e)
+            return
+        if written:
+            logger.info("退出前刷写命中记录：%s 条，用时 %.2fs", written, time.monotonic() - started)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "buffered": len(self._buffer),
+            "flushed_rows": self.flushed_rows,
+            "flushes": self.flushes,
+            "failed_rows": self.failed_rows,
+            "dropped_rows": self.dropped_rows,
+            "duplicate_adds": self.duplicate_adds,
+            "backpressure_waits": self.backpressure_waits,
+        }
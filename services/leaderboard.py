@@ -0,0 +1,192 @@
+from __future__ import annotations
+
+import logging
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+
+logger = logging.getLogger(__name__)
+
+
+LEADERBOARD_PREFIX = "wd:lb:"
+METRIC_COUNT = "cnt"
+METRIC_AMOUNT = "amt"
+METRICS = (METRIC_COUNT, METRIC_AMOUNT)
+
+WINDOW_ALL = "all"
+WINDOW_24H = "24h"
+WINDOW_7D = "7d"
+WINDOW_30D = "30d"
+WINDOWS = (WINDOW_ALL, WINDOW_24H, WINDOW_7D, WINDOW_30D)
+
+# 分桶保留时长：24h 窗口由小时桶合并，7d/30d 由天桶合并
+HOUR_BUCKET_TTL = 49 * 3600
+DAY_BUCKET_TTL = 31 * 86400
+# 合并后的窗口集合缓存时长，期间同一窗口的读取只是一次 ZREVRANGE
+MERGED_TTL = 15
+# 重建完成标记：只由 rebuild() 写入，实时累加不会创建，避免未重建时只有增量数据的排行被当作完整结果
+BUILT_KEY = f"{LEADERBOARD_PREFIX}built"
+
+
+def _key(metric: str, suffix: str) -> str:
+    return f"{LEADERBOARD_PREFIX}{metric}:{suffix}"
+
+
+def hour_key(metric: str, ts: datetime) -> str:
+    return _key(metric, f"h:{ts:%Y%m%d%H}")
+
+
+def day_key(metric: str, ts: datetime) -> str:
+    return _key(metric, f"d:{ts:%Y%m%d}")
+
+
+def all_key(metric: str) -> str:
+    return _key(metric, WINDOW_ALL)
+
+
+def window_keys(metric: str, window: str, now: datetime) -> List[str]:
+    """窗口包含的分桶键。7d/30d 以自然日为粒度（含今天），24h 以整点小时为粒度（含当前小时）。"""
+    if window == WINDOW_24H:
+        return [hour_key(metric, now - timedelta(hours=i)) for i in range(24)]
+    days = 7 if window == WINDOW_7D else 30
+    return [day_key(metric, now - timedelta(days=i)) for i in range(days)]
+
+
+def window_start(window: str, now: datetime) -> Optional[datetime]:
+    """窗口的起始时间（与 window_keys 的分桶范围一致），供回退到数据库查询时使用；all 返回 None。"""
+    if window == WINDOW_24H:
+        return now.replace(minute=0, second=0, microsecond=0) - timedelta(hours=23)
+    if window in (WINDOW_7D, WINDOW_30D):
+        days = 7 if window == WINDOW_7D else 30
+        return now.replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=days - 1)
+    return None
+
+
+class Leaderboard:
+    """
+    Redis 有序集合维护的用户排行榜（按笔数与金额）：每批命中落库后 ZINCRBY 累加到
+    全量、小时桶、天桶三类集合；滚动窗口读时 ZUNIONSTORE 合并对应分桶并短暂缓存。
+    与小时汇总表一致，用户名含 bot 的命中不计入。
+    """
+
+    def __init__(self, redis_client, tzinfo: Any) -> None:
+        self.redis = redis_client
+        self.tzinfo = tzinfo
+
+    def _now(self) -> datetime:
+        # 与 hits.hit_at 一致：按配置时区的本地时间（无时区信息）
+        return datetime.now(self.tzinfo).replace(tzinfo=None)
+
+    async def record(self, rows: Iterable[Dict[str, Any]]) -> None:
+        """累加一批命中（字段同 hits 行：username/amount/hit_at/is_bot）。"""
+        incr: Dict[Tuple[str, str], int] = defaultdict(int)
+        ttls: Dict[str, int] = {}
+        for r in rows:
+            username = r.get("username")
+            if not username or r.get("is_bot"):
+                continue
+            hit_at: datetime = r["hit_at"]
+            for metric, value in ((METRIC_COUNT, 1), (METRIC_AMOUNT, int(r["amount"]))):
+                incr[(all_key(metric), username)] += value
+                hk, dk = hour_key(metric, hit_at), day_key(metric, hit_at)
+                incr[(hk, username)] += value
+                incr[(dk, username)] += value
+                ttls[hk] = HOUR_BUCKET_TTL
+                ttls[dk] = DAY_BUCKET_TTL
+        if not incr:
+            return
+        pipe = self.redis.client.pipeline(transaction=False)
+        for (key, member), value in incr.items():
+            pipe.zincrby(key, value, member)
+        for key, ttl in ttls.items():
+            pipe.expire(key, ttl)
+        await pipe.execute()
+
+    async def available(self) -> bool:
+        """执行过重建才认为排行榜可用（首次上线需先执行 --rebuild-leaderboards）。"""
+        return bool(await self.redis.client.exists(BUILT_KEY))
+
+    async def _window_key(self, metric: str, window: str) -> str:
+        if window == WINDOW_ALL:
+            return all_key(metric)
+        dest = _key(metric, f"w:{window}")
+        client = self.redis.client
+        if not await client.exists(dest):
+            keys = window_keys(metric, window, self._now())
+            pipe = client.pipeline(transaction=True)
+            pipe.zunionstore(dest, keys)
+            pipe.expire(dest, MERGED_TTL)
+            await pipe.execute()
+        return dest
+
+    async def top(self, window: str = WINDOW_ALL, limit: int = 50) -> Dict[str, List[Dict[str, Any]]]:
+        """返回与 Database.query_top_users_dual 相同结构的排行。"""
+        if window not in WINDOWS:
+            raise ValueError(f"不支持的排行窗口：{window}")
+        cnt_key = await self._window_key(METRIC_COUNT, window)
+        amt_key = await self._window_key(METRIC_AMOUNT, window)
+        client = self.redis.client
+        by_cnt = await client.zrevrange(cnt_key, 0, limit - 1, withscores=True)
+        by_amt = await client.zrevrange(amt_key, 0, limit - 1, withscores=True)
+        # 补齐另一维度的分数
+        pipe = client.pipeline(transaction=False)
+        for member, _ in by_cnt:
+            pipe.zscore(amt_key, member)
+        for member, _ in by_amt:
+            pipe.zscore(cnt_key, member)
+        others = await pipe.execute()
+        amt_of = others[: len(by_cnt)]
+        cnt_of = others[len(by_cnt):]
+        return {
+            "by_count": [
+                {"username": m, "count": int(c), "amount": int(a or 0)} for (m, c), a in zip(by_cnt, amt_of)
+            ],
+            "by_amount": [
+                {"username": m, "count": int(c or 0), "amount": int(a)} for (m, a), c in zip(by_amt, cnt_of)
+            ],
+        }
+
+    async def clear(self) -> int:
+        client = self.redis.client
+        removed = 0
+        batch: List[str] = []
+        async for key in client.scan_iter(match=f"{LEADERBOARD_PREFIX}*", count=1000):
+            batch.append(key)
+            if len(batch) >= 500:
+                removed += await client.delete(*batch)
+                batch = []
+        if batch:
+            removed += await client.delete(*batch)
+        return removed
+
+    async def rebuild(self, db, chunk_size: int = 5000) -> Dict[str, int]:
+        """从小时汇总表重建全部排行集合：全量、最近 48 小时的小时桶与最近 30 天的天桶。"""
+        await self.clear()
+        now = self._now()
+        counts: Dict[str, int] = {}
+        plans: List[Tuple[str, Optional[datetime], Any]] = [
+            (WINDOW_ALL, None, lambda m, b: all_key(m)),
+            ("hour", now - timedelta(hours=48), hour_key),
+            ("day", now - timedelta(days=31), day_key),
+        ]
+        client = self.redis.client
+        for unit, since, key_fn in plans:
+            rows = await db.query_user_rollup_totals(unit=unit, since=since)
+            ttl = {"hour": HOUR_BUCKET_TTL, "day": DAY_BUCKET_TTL}.get(unit)
+            for i in range(0, len(rows), chunk_size):
+                pipe = client.pipeline(transaction=False)
+                touched = set()
+                for bucket, username, hits, amount in rows[i : i + chunk_size]:
+                    for metric, value in ((METRIC_COUNT, hits), (METRIC_AMOUNT, amount)):
+                        key = key_fn(metric, bucket)
+                        pipe.zincrby(key, int(value or 0), username)
+                        touched.add(key)
+                if ttl:
+                    for key in touched:
+                        pipe.expire(key, ttl)
+                await pipe.execute()
+            counts[unit] = len(rows)
+        await client.set(BUILT_KEY, int(now.timestamp()))
+        logger.info("排行榜已从汇总表重建：%s", counts)
+        return counts
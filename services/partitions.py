@@ -0,0 +1,190 @@
+"""
+hits 表按月范围分区（RANGE (hit_at)）的维护工具：
+- 预建当前及未来若干个月的分区，并保留 hits_default 兜底分区；
+- 将旧的非分区 hits 表迁移为分区表；
+- 保留期之外的分区先 DETACH，再导出为 gzip 压缩的 CSV 后删除。
+"""
+
+from __future__ import annotations
+
+import asyncio
+import gzip
+import logging
+import os
+from datetime import datetime
+from typing import Any, List, Optional, Tuple
+
+from sqlalchemy import text
+
+
+logger = logging.getLogger(__name__)
+
+
+PARTITION_PREFIX = "hits_p"
+DEFAULT_PARTITION = "hits_default"
+
+
+def month_start(ts: datetime) -> datetime:
+    return ts.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def add_months(ts: datetime, months: int) -> datetime:
+    idx = ts.year * 12 + (ts.month - 1) + months
+    return ts.replace(year=idx // 12, month=idx % 12 + 1, day=1)
+
+
+def partition_name(ts: datetime) -> str:
+    return f"{PARTITION_PREFIX}{ts:%Y%m}"
+
+
+def parse_partition_name(name: str) -> Optional[datetime]:
+    if not name.startswith(PARTITION_PREFIX):
+        return None
+    try:
+        return datetime.strptime(name[len(PARTITION_PREFIX):], "%Y%m")
+    except ValueError:
+        return None
+
+
+async def is_partitioned(conn: Any, table: str = "hits") -> bool:
+    res = await conn.execute(
+        text("SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(:t)"), {"t": table}
+    )
+    return res.scalar() is not None
+
+
+async def list_partitions(conn: Any, table: str = "hits") -> List[str]:
+    res = await conn.execute(
+        text(
+            """
+            SELECT c.relname FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = to_regclass(:t)
+            ORDER BY c.relname
+            """
+        ),
+        {"t": table},
+    )
+    return [r[0] for r in res.all()]
+
+
+async def list_detached(conn: Any) -> List[str]:
+    """已 DETACH 但尚未归档删除的月分区（上次归档中途失败时残留）。"""
+    res = await conn.execute(
+        text(
+            """
+            SELECT c.relname FROM pg_class c
+            WHERE c.relkind = 'r' AND c.relname LIKE :prefix
+              AND NOT EXISTS (SELECT 1 FROM pg_inherits i WHERE i.inhrelid = c.oid)
+            ORDER BY c.relname
+            """
+        ),
+        {"prefix": PARTITION_PREFIX.replace("_", "\\_") + "%"},
+    )
+    return [r[0] for r in res.all()]
+
+
+async def ensure_partitions(conn: Any, start: datetime, months_ahead: int) -> List[str]:
+    """
+    确保从 start 所在月到当前月之后 months_ahead 个月的分区均已存在，返回新建的分区名。
+    hits_default 中已有落在新月份范围内的行时（如未及时预建分区），先将这些行移入新分区再挂载，
+    否则 PostgreSQL 会拒绝创建与默认分区数据重叠的分区。
+    """
+    existing = set(await list_partitions(conn))
+    created: List[str] = []
+    if DEFAULT_PARTITION not in existing:
+        await conn.execute(text(f"CREATE TABLE IF NOT EXISTS {DEFAULT_PARTITION} PARTITION OF hits DEFAULT"))
+    cur = month_start(start)
+    last = add_months(month_start(datetime.now()), months_ahead)
+    while cur <= last:
+        name = partition_name(cur)
+        if name not in existing:
+            nxt = add_months(cur, 1)
+            bounds = f"FOR VALUES FROM ('{cur:%Y-%m-%d}') TO ('{nxt:%Y-%m-%d}')"
+            if await _default_has_rows(conn, cur, nxt):
+                await _attach_from_default(conn, name, cur, nxt, bounds)
+            else:
+                await conn.execute(text(f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF hits {bounds}"))
+            created.append(name)
+        cur = add_months(cur, 1)
+    if created:
+        logger.info("已创建 hits 分区：%s", ", ".join(created))
+    return created
+
+
+async def _default_has_rows(conn: Any, start: datetime, end: datetime) -> bool:
+    res = await conn.execute(
+        text(f"SELECT EXISTS (SELECT 1 FROM {DEFAULT_PARTITION} WHERE hit_at >= :a AND hit_at < :b)"),
+        {"a": start, "b": end},
+    )
+    return bool(res.scalar())
+
+
+async def _attach_from_default(conn: Any, name: str, start: datetime, end: datetime, bounds: str) -> None:
+    """新建独立表，将 hits_default 中该月的行移入后再 ATTACH（挂载时自动补建分区索引）。"""
+    await conn.execute(text(f"CREATE TABLE {name} (LIKE hits INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"))
+    res = await conn.execute(
+        text(
+            f"""
+            WITH moved AS (
+                DELETE FROM {DEFAULT_PARTITION} WHERE hit_at >= :a AND hit_at < :b RETURNING *
+            )
+            INSERT INTO {name} SELECT * FROM moved
+            """
+        ),
+        {"a": start, "b": end},
+    )
+    await conn.execute(text(f"ALTER TABLE hits ATTACH PARTITION {name} {bounds}"))
+    logger.info("已将 %s 中的 %s 行移入新分区 %s", DEFAULT_PARTITION, res.rowcount, name)
+
+
+async def rename_legacy_objects(conn: Any, legacy: str) -> None:
+    """旧表改名后，其索引/主键/序列仍占用原名，需一并改名，避免与新建的分区表冲突。"""
+    res = await conn.execute(text("SELECT indexname FROM pg_indexes WHERE tablename = :t"), {"t": legacy})
+    for (name,) in res.all():
+        await conn.execute(text(f'ALTER INDEX "{name}" RENAME TO "{name}_legacy"'))
+    seq = await conn.execute(text("SELECT pg_get_serial_sequence(:t, 'id')"), {"t": legacy})
+    seq_name = seq.scalar()
+    if seq_name:
+        await conn.execute(text(f"ALTER SEQUENCE {seq_name} RENAME TO {legacy}_id_seq"))
+
+
+async def detach_and_archive(conn_factory: Any, cutoff: datetime, archive_dir: str) -> List[Tuple[str, str, int]]:
+    """
+    将整月都早于 cutoff 的分区 DETACH 后导出为 archive_dir/<分区名>.csv.gz 并删除。
+    conn_factory 为 AsyncEngine；每个分区单独事务处理，导出失败的分区保持 detached 状态，不会被删除。
+    返回 [(分区名, 文件路径, 行数)]。
+    """
+    os.makedirs(archive_dir, exist_ok=True)
+    async with conn_factory.connect() as conn:
+        attached = await list_partitions(conn)
+        detached = await list_detached(conn)
+    archived: List[Tuple[str, str, int]] = []
+    for name in sorted(set(attached) | set(detached)):
+        start = parse_partition_name(name)
+        if start is None or add_months(start, 1) > cutoff:
+            continue
+        path = os.path.join(archive_dir, f"{name}.csv.gz")
+        if name in attached:
+            async with conn_factory.begin() as conn:
+                await conn.execute(text(f"ALTER TABLE hits DETACH PARTITION {name}"))
+        async with conn_factory.connect() as conn:
+            raw = await conn.get_raw_connection()
+            driver = raw.driver_connection
+            rows = await driver.fetchval(f"SELECT count(*) FROM {name}")
+            tmp_path = path + ".tmp"
+            # 压缩与写文件放到线程中执行，避免阻塞事件循环
+            fh = await asyncio.to_thread(gzip.open, tmp_path, "wb")
+            try:
+                async def _sink(chunk: bytes) -> None:
+                    await asyncio.to_thread(fh.write, chunk)
+
+                await driver.copy_from_table(name, output=_sink, format="csv", header=True)
+            finally:
+                await asyncio.to_thread(fh.close)
+            os.replace(tmp_path, path)
+        async with conn_factory.begin() as conn:
+            await conn.execute(text(f"DROP TABLE {name}"))
+        logger.info("分区已归档并删除：%s -> %s（%s 行）", name, path, rows)
+        archived.append((name, path, int(rows or 0)))
+    return archived
@@ -0,0 +1,126 @@
+from __future__ import annotations
+
+import inspect
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Union
+
+from .filters import MatchResult
+
+
+logger = logging.getLogger(__name__)
+
+
+# 阶段成本：纯 CPU 检查必须排在需要 Telegram RPC 的检查之前
+COST_CPU = "cpu"
+COST_RPC = "rpc"
+
+
+@dataclass
+class MessageContext:
+    """单条消息在过滤管线中流转的上下文，各阶段可读写其中字段。"""
+
+    event: Any
+    message: Any = None
+    text: str = ""
+    match: Optional[MatchResult] = None
+    sender: Any = None
+    username: Optional[str] = None
+    user_id: Optional[int] = None
+    chat_id: Optional[int] = None
+    chat_title: str = ""
+    extras: Dict[str, Any] = field(default_factory=dict)
+
+
+# 阶段函数：返回 True 表示放行，False 表示丢弃；可为同步或异步函数
+StageFunc = Callable[[MessageContext], Union[bool, Awaitable[bool]]]
+
+
+@dataclass
+class FilterStage:
+    name: str
+    func: StageFunc
+    cost: str = COST_CPU
+    passed: int = 0
+    dropped: int = 0
+    errors: int = 0
+    total_ns: int = 0
+
+
+class MessagePipeline:
+    """
+    有序的消息过滤管线：按注册顺序逐个执行阶段，任一阶段返回 False 即终止。
+    每个阶段独立统计放行/丢弃/异常次数与累计耗时，便于定位热点。
+    """
+
+    def __init__(self) -> None:
+        self._stages: List[FilterStage] = []
+        self.processed = 0
+        self.accepted = 0
+
+    def add_stage(
+        self,
+        name: str,
+        func: StageFunc,
+        cost: str = COST_CPU,
+        before: Optional[str] = None,
+    ) -> None:
+        if any(s.name == name for s in self._stages):
+            raise ValueError(f"过滤阶段重复：{name}")
+        stage = FilterStage(name=name, func=func, cost=cost)
+        if before is None:
+            self._stages.append(stage)
+            return
+        for idx, s in enumerate(self._stages):
+            if s.name == before:
+                self._stages.insert(idx, stage)
+                return
+        raise ValueError(f"未找到过滤阶段：{before}")
+
+    def remove_stage(self, name: str) -> None:
+        self._stages = [s for s in self._stages if s.name != name]
+
+    @property
+    def stage_names(self) -> List[str]:
+        return [s.name for s in self._stages]
+
+    async def run(self, ctx: MessageContext) -> bool:
+        self.processed += 1
+        for stage in self._stages:
+            started = time.perf_counter_ns()
+            try:
+                result = stage.func(ctx)
+                if inspect.isawaitable(result):
+                    result = await result
+            except Exception as e:
+                # 阶段异常视为丢弃，避免异常消息继续消耗后续 RPC
+                stage.errors += 1
+                stage.dropped += 1
+                stage.total_ns += time.perf_counter_ns() - started
+                logger.debug("过滤阶段 %s 异常：%s", stage.name, e)
+                return False
+            stage.total_ns += time.perf_counter_ns() - started
+            if not result:
+                stage.dropped += 1
+                return False
+            stage.passed += 1
+        self.accepted += 1
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "processed": self.processed,
+            "accepted": self.accepted,
+            "stages": [
+                {
+                    "name": s.name,
+                    "cost": s.cost,
+                    "passed": s.passed,
+                    "dropped": s.dropped,
+                    "errors": s.errors,
+                    "avg_us": round(s.total_ns / max(1, s.passed + s.dropped) / 1000, 2),
+                }
+                for s in self._stages
+            ],
+        }
@@ -0,0 +1,127 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+
+logger = logging.getLogger(__name__)
+
+
+QUERY_CACHE_PREFIX = "wd:qc:"
+
+
+def _normalize(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return value.isoformat(timespec="seconds")
+    return value
+
+
+def cache_key(method: str, kwargs: Dict[str, Any]) -> str:
+    """方法名 + 规范化参数（去掉 None、按名排序）生成缓存键，调用方传参顺序与默认值写法不影响命中。"""
+    norm = {k: _normalize(v) for k, v in sorted(kwargs.items()) if v is not None}
+    digest = hashlib.sha1(json.dumps(norm, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:16]
+    return f"{QUERY_CACHE_PREFIX}{method}:{digest}"
+
+
+class QueryCache:
+    """
+    Database 查询结果的 Redis 缓存，多个 uvicorn worker 共享。
+    缓存条目记录计算时的数据版本号（insert_hits 等写入时递增）：版本一致且未超过 ttl 时直接命中；
+    版本已变或超过 ttl、但仍在 stale_ttl 内时先返回旧值，并在后台刷新（同一键跨进程只刷新一次）；
+    超过 stale_ttl 或无缓存时同步查询；ttl 为 0 时不缓存。结果须可 JSON 序列化。
+    """
+
+    def __init__(self, db, redis_client, ttl: float = 30.0, stale_ttl: float = 600.0) -> None:
+        self.db = db
+        self.redis = redis_client
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        # 进行中的后台刷新任务（持有引用，避免任务被回收）
+        self._refreshing: Dict[str, asyncio.Task] = {}
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.errors = 0
+
+    async def get(self, method: str, **kwargs: Any) -> Any:
+        if self.ttl <= 0:
+            # ttl 为 0 表示关闭缓存
+            return await getattr(self.db, method)(**kwargs)
+        key = cache_key(method, kwargs)
+        version = await self.db.data_version()
+        entry = await self._load(key)
+        if entry is not None:
+            age = time.time() - entry["t"]
+            if entry["v"] == version and age < self.ttl:
+                self.hits += 1
+                return entry["data"]
+            if age < self.stale_ttl:
+                self.stale_hits += 1
+                self._schedule_refresh(key, method, kwargs)
+                return entry["data"]
+        self.misses += 1
+        return await self._compute(key, method, kwargs, version)
+
+    async def _load(self, key: str) -> Optional[Dict[str, Any]]:
+        try:
+            raw = await self.redis.client.get(key)
+        except Exception as e:
+            self.errors += 1
+            logger.warning("读取查询缓存失败：%s", e)
+            return None
+        if raw is None:
+            return None
+        try:
+            return json.loads(raw)
+        except ValueError:
+            return None
+
+    async def _compute(self, key: str, method: str, kwargs: Dict[str, Any], version: int) -> Any:
+        data = await getattr(self.db, method)(**kwargs)
+        entry = json.dumps({"v": version, "t": time.time(), "data": data}, ensure_ascii=False, default=str)
+        try:
+            await self.redis.client.set(key, entry, ex=int(self.stale_ttl))
+        except Exception as e:
+            self.errors += 1
+            logger.warning("写入查询缓存失败：%s", e)
+        return data
+
+    def _schedule_refresh(self, key: str, method: str, kwargs: Dict[str, Any]) -> None:
+        if key in self._refreshing:
+            return
+        self._refreshing[key] = asyncio.create_task(
+            self._refresh(key, method, kwargs), name=f"query-cache-refresh:{method}"
+        )
+
+    async def _refresh(self, key: str, method: str, kwargs: Dict[str, Any]) -> None:
+        lock_key = f"{key}:lock"
+        try:
+            # 跨 worker 去重：拿到锁的进程负责刷新，锁在 ttl 后自动过期，也限制了刷新频率
+            if not await self.redis.client.set(lock_key, 1, nx=True, ex=max(1, int(self.ttl))):
+                return
+            version = await self.db.data_version()
+            await self._compute(key, method, kwargs, version)
+            self.refreshes += 1
+        except Exception as e:
+            self.errors += 1
+            logger.warning("后台刷新查询缓存失败（%s）：%s", method, e)
+        finally:
+            self._refreshing.pop(key, None)
+
+    def stats(self) -> Dict[str, Any]:
+        served = self.hits + self.stale_hits
+        total = served + self.misses
+        return {
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "refreshes": self.refreshes,
+            "errors": self.errors,
+            "hit_ratio": round(served / total, 3) if total else None,
+        }
@@ -1,12 +1,13 @@
 import logging
 import inspect
-from typing import Optional, Any
+from typing import Optional, Any, Dict, Sequence
 from urllib.parse import urlparse, urlunparse
 
 try:
     from redis.asyncio import Redis  # type: ignore
 except ImportError:
     from redis import Redis  # type: ignore  # 回退到同步版本
+from redis.exceptions import NoScriptError
 
 
 logger = logging.getLogger(__name__)
@@ -17,6 +18,8 @@ class RedisClient:
         self.redis_url = redis_url
         # 兼容异步/同步 Redis 客户端
         self._client: Optional[Any] = None
+        # Lua 脚本 SHA 缓存：源码 -> sha1，脚本只需加载一次
+        self._script_shas: Dict[str, str] = {}
 
     async def connect(self) -> None:
         if self._client is None:
@@ -50,6 +53,20 @@ class RedisClient:
         assert self._client is not None, "Redis 尚未连接"
         return self._client
 
+    async def run_script(self, source: str, keys: Sequence[Any], args: Sequence[Any]) -> Any:
+        """以 EVALSHA 执行 Lua 脚本；服务端脚本缓存丢失（NOSCRIPT）时重新加载后重试一次。"""
+        sha = self._script_shas.get(source)
+        if sha is None:
+            sha = await self.client.script_load(source)
+            self._script_shas[source] = sha
+        try:
+            return await self.client.evalsha(sha, len(keys), *keys, *args)
+        except NoScriptError:
+            logger.warning("Redis 脚本缓存丢失，重新加载：%s", sha)
+            sha = await self.client.script_load(source)
+            self._script_shas[source] = sha
+            return await self.client.evalsha(sha, len(keys), *keys, *args)
+
     async def close(self) -> None:
         if self._client is not None:
             close_fn = getattr(self._client, "close", None) or getattr(self._client, "aclose", None)
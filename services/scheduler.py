@@ -1,86 +1,170 @@
 from __future__ import annotations
 
 import asyncio
+import functools
 import json
 import logging
+import os
+import statistics
 import time
+from collections import deque
 from datetime import datetime, timezone
-from typing import Any, Dict, Optional
+from typing import Any, Deque, Dict, List, Optional, Tuple
 
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
+from .aggregation import AGG_PREFIX, AGG_DUE_KEY
+from .dispatcher import PRIORITY_HIGH, PRIORITY_NORMAL, SendDispatcher
+from .forward_queue import FORWARD_QUEUE_KEY, build_forward_queue
+
 
 logger = logging.getLogger(__name__)
 
 
-AGG_PREFIX = "wd:agg:"
-FORWARD_QUEUE_KEY = "wd:fwd:q"
 LAST_SENT_PREFIX = "wd:last_sent:"
 
+# 原子领取到期聚合：取出到期索引中分值 <= now 的成员并移除，
+# 仅返回仍存在且未发送的键，同时将其 sent 从 0 置为 1，避免并发重复
+CLAIM_DUE_LUA = """
+local members = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+local claimed = {}
+for _, key in ipairs(members) do
+  redis.call('ZREM', KEYS[1], key)
+  local s = redis.call('HGET', key, 'sent')
+  if s and tonumber(s) == 0 then
+    redis.call('HSET', key, 'sent', 1)
+    table.insert(claimed, key)
+  end
+end
+return {#members, claimed}
+"""
+
+# 单次领取上限
+CLAIM_BATCH_SIZE = 500
+
+# 告警卡片模式：single 为时间并入卡片、每条告警一次 send_message；split 为旧版“时间 + 卡片”两条消息
+CARD_MODE_SINGLE = "single"
+CARD_MODE_SPLIT = "split"
+DIGEST_PREFIX = "wd:digest:"
+DIGEST_SEPARATOR = "────────"
+DIGEST_MAX_CHARS = 4000
+
 
 class AggregationScheduler:
     """
     负责周期扫描 Redis 聚合键，到期后进行一次性转发与入库。
     """
 
-    def __init__(self, redis_client, db, bot, target_chat_id: int, tzinfo, refresh_groups_cb=None):
+    def __init__(self, redis_client, db, bot, target_chat_id: int, tzinfo, refresh_groups_cb=None, hit_writer=None):
         self.redis = redis_client
         self.db = db
+        # 命中记录写入：提供 HitBatcher 时走批量写后缓冲，否则逐条写入
+        self.hit_writer = hit_writer
         self.bot = bot
         self.target_chat_id = target_chat_id
         self.tzinfo = tzinfo
         self.scheduler = AsyncIOScheduler(timezone=str(tzinfo))
         self.refresh_groups_cb = refresh_groups_cb
+        # 转发队列：FORWARD_QUEUE_MODE=list（默认）或 stream
+        self.queue = build_forward_queue(redis_client)
+        # 常驻转发消费者：阻塞等待队列，有条目立即分发
+        self.forward_workers = max(1, int(os.getenv("FORWARD_WORKERS", "2") or 2))
+        self.forward_block_ms = max(100, int(os.getenv("FORWARD_BLOCK_MS", "5000") or 5000))
+        # 停止时等待消费者处理完当前条目的最长秒数，超时后取消（未处理条目放回队列）
+        self.forward_shutdown_timeout = float(os.getenv("FORWARD_SHUTDOWN_TIMEOUT", "10") or 10)
+        self._worker_tasks: List[asyncio.Task] = []
+        self._stopping = False
+        # Bot 发送统一经由限速调度器；金额达到阈值的告警走高优先级通道
+        self.dispatcher = SendDispatcher(
+            bot,
+            global_rate=float(os.getenv("SEND_GLOBAL_RATE", "25") or 25),
+            chat_rate_per_minute=float(os.getenv("SEND_CHAT_RATE_PER_MIN", "20") or 20),
+        )
+        self.priority_amount = int(os.getenv("SEND_PRIORITY_AMOUNT", "10000") or 10000)
+        self.card_mode = os.getenv("ALERT_CARD_MODE", CARD_MODE_SINGLE).strip().lower()
+        # 摘要模式：积压达到阈值时，将卡片缓冲并每 N 秒合并为一条消息发送；间隔为 0 表示关闭
+        self.digest_interval = int(os.getenv("ALERT_DIGEST_INTERVAL", "0") or 0)
+        self.digest_threshold = int(os.getenv("ALERT_DIGEST_THRESHOLD", "20") or 20)
+        # 待合并的卡片保存在 Redis 列表（每个目标群一个），发送成功后才移除，重启不丢失
+        self.digest_key = f"{DIGEST_PREFIX}{target_chat_id}"
+        self._digest_pending = 0
+        self._digest_lock = asyncio.Lock()
+        # 各消费者当前批次中尚未处理的条数
+        self._backlogs: Dict[int, int] = {}
+        self.digest_flushes = 0
+        # 最近的入队到发送延迟（毫秒）
+        self._latencies_ms: Deque[float] = deque(maxlen=1000)
 
     async def start(self) -> None:
+        await self.queue.setup()
+        await self.rebuild_due_index()
         # 每 10 秒扫描一次
         self.scheduler.add_job(self.process_due_aggregations, "interval", seconds=10, id="scan_aggregations", replace_existing=True)
         # 每小时清理一次老旧键
         self.scheduler.add_job(self.cleanup_old_keys, "interval", minutes=60, id="cleanup_keys", replace_existing=True)
-        # 每 2 秒消费一次转发队列
-        self.scheduler.add_job(self.process_forward_queue, "interval", seconds=2, id="forward_queue", replace_existing=True)
         # 每小时刷新一次群组目录（如果提供了回调）
         if self.refresh_groups_cb is not None:
             self.scheduler.add_job(self.refresh_groups_cb, "interval", hours=1, id="refresh_groups", replace_existing=True)
+        # 每天凌晨维护 hits 分区：预建未来分区、归档超出保留期的分区
+        self.scheduler.add_job(self.db.run_retention, "cron", hour=4, minute=10, id="hits_retention", replace_existing=True)
+        # 告警摘要定时合并发送（如果开启）
+        if self.digest_interval > 0:
+            self.scheduler.add_job(self.flush_digest, "interval", seconds=self.digest_interval, id="alert_digest", replace_existing=True)
         self.scheduler.start()
         logger.info("APScheduler 已启动")
+        self._stopping = False
+        self.dispatcher.start()
+        for i in range(self.forward_workers):
+            self._worker_tasks.append(asyncio.create_task(self._forward_worker(i), name=f"forward-worker-{i}"))
+        logger.info("转发消费者已启动：%s 个", self.forward_workers)
 
     async def shutdown(self) -> None:
         self.scheduler.shutdown(wait=False)
         logger.info("APScheduler 已停止")
+        # 先通知消费者在当前条目处理完后退出，超时再取消
+        self._stopping = True
+        if self._worker_tasks:
+            _, pending = await asyncio.wait(self._worker_tasks, timeout=self.forward_shutdown_timeout)
+            for task in pending:
+                task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks.clear()
+        # 退出前尽量发送摘要；未发送成功的卡片保留在 Redis，重启后继续发送
+        await self.flush_digest()
+        await self.dispatcher.stop()
+        logger.info("转发消费者已停止")
 
-    async def process_due_aggregations(self) -> None:
-        now = int(time.time())
-        pattern = AGG_PREFIX + "*"
-        async for key in self.redis.client.scan_iter(match=pattern, count=500):
-            data = await self.redis.client.hgetall(key)
-            if not data:
-                continue
-            finalize_at = int(data.get("finalize_at", 0))
-            if int(data.get("sent", 0)):
-                continue
-            if now < finalize_at:
-                continue
-
-            # 使用 Lua 原子检查并抢占发送（sent 从 0 -> 1），避免并发重复
-            lua = """
-            if redis.call('HEXISTS', KEYS[1], 'sent') == 0 then return 0 end
-            local s = tonumber(redis.call('HGET', KEYS[1], 'sent') or '0')
-            if s ~= 0 then return 0 end
-            redis.call('HSET', KEYS[1], 'sent', 1)
-            return 1
-            """
-            try:
-                claimed = await self.redis.client.eval(lua, 1, key)
-            except Exception:
-                claimed = 0
-            if not claimed:
+    async def rebuild_due_index(self) -> int:
+        """启动时将索引上线前遗留的未发送聚合键补登记到到期索引（仅需一次 SCAN）。"""
+        added = 0
+        async for key in self.redis.client.scan_iter(match=AGG_PREFIX + "*", count=1000):
+            data = await self.redis.client.hmget(key, "finalize_at", "sent")
+            finalize_at, sent = data[0], data[1]
+            if finalize_at is None or int(sent or 0):
                 continue
+            added += int(await self.redis.client.zadd(AGG_DUE_KEY, {key: int(finalize_at)}, nx=True) or 0)
+        if added:
+            logger.info("到期索引补登记：%s 条", added)
+        return added
 
+    async def process_due_aggregations(self) -> None:
+        now = int(time.time())
+        while True:
+            # 按到期时间区间查询，只触达真正到期的键
             try:
-                await self._finalize_one(key, data)
+                scanned, claimed = await self.redis.run_script(CLAIM_DUE_LUA, [AGG_DUE_KEY], [now, CLAIM_BATCH_SIZE])
             except Exception as e:
-                logger.exception("聚合发送失败 %s: %s", key, e)
+                logger.exception("领取到期聚合失败：%s", e)
+                return
+            for key in claimed:
+                try:
+                    data = await self.redis.client.hgetall(key)
+                    if data:
+                        await self._finalize_one(key, data)
+                except Exception as e:
+                    logger.exception("聚合发送失败 %s: %s", key, e)
+            if int(scanned) < CLAIM_BATCH_SIZE:
+                break
 
     async def _finalize_one(self, key: str, data: Dict[str, Any]) -> None:
         """聚合完成后写入转发队列，由专门消费者做去重与转发。"""
@@ -102,9 +186,9 @@ class AggregationScheduler:
             "chat_title_raw": str(data.get("chat_title") or ""),
             "user_id": int(data.get("user_id", 0)) if data.get("user_id") else None,
             "hit_at_ts": int(data.get("hit_at_ts", 0)),
-            "enqueued_ts": int(time.time()),
+            "enqueued_ts": time.time(),
         }
-        await self.redis.client.rpush(FORWARD_QUEUE_KEY, json.dumps(payload))
+        await self.queue.push(payload)
         await self.redis.client.hset(key, mapping={"sent": 1})
         await self.redis.client.expire(key, 600)
         logger.info("聚合已入队：%s", username_raw)
@@ -117,78 +201,202 @@ class AggregationScheduler:
             return "@" + u[1:].lower()
         return "@" + u.lower()
 
-    async def process_forward_queue(self) -> None:
-        from .filters import escape_html, format_amount_with_thousands
-        # 每次最多处理 100 条
-        for _ in range(100):
-            item = await self.redis.client.lpop(FORWARD_QUEUE_KEY)
-            if not item:
-                break
+    async def _forward_worker(self, idx: int) -> None:
+        while not self._stopping:
             try:
-                data = json.loads(item)
-            except Exception:
-                continue
+                await self.process_forward_queue(block_ms=self.forward_block_ms, worker=idx)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception("转发消费者 %s 异常：%s", idx, e)
+                await asyncio.sleep(1)
 
-            username_raw = str(data.get("username_raw") or "")
-            uname = self._normalize_username(username_raw).lstrip("@").lower()
-            if uname.endswith("bot") or uname.endswith("_bot") or ("bot" in uname):
-                continue
+    async def process_forward_queue(self, block_ms: Optional[int] = None, worker: int = 0) -> None:
+        # 每次最多处理 100 条；命中落库后才确认，Streams 模式下失败或未落库的条目会被重新接管
+        batch = await self.queue.pop_batch(100, block_ms=block_ms)
+        self._backlogs[worker] = len(batch)
+        done = 0
+        try:
+            for entry_id, data in batch:
+                if self._stopping:
+                    break
+                self._backlogs[worker] -= 1
+                try:
+                    await self._forward_one(entry_id, data)
+                except Exception as e:
+                    logger.exception("转发处理失败 %s: %s", entry_id, e)
+                done += 1
+        finally:
+            # 停止或被取消时，将尚未处理完的条目（含被中断的当前条目）放回队列
+            self._backlogs[worker] = 0
+            if done < len(batch):
+                await self.queue.requeue(batch[done:])
 
-            # 10 分钟唯一：SET NX EX
-            last_key = LAST_SENT_PREFIX + self._normalize_username(username_raw)
-            ok = await self.redis.client.set(last_key, str(int(time.time())), ex=600, nx=True)
-            if not ok:
-                continue
+    def forward_stats(self) -> Dict[str, Any]:
+        samples = list(self._latencies_ms)
+        return {
+            "workers": len(self._worker_tasks),
+            "latency_samples": len(samples),
+            "latency_p50_ms": round(statistics.median(samples), 1) if samples else None,
+            "latency_max_ms": round(max(samples), 1) if samples else None,
+            "card_mode": self.card_mode,
+            "digest_buffered": self._digest_pending,
+            "digest_flushes": self.digest_flushes,
+        }
 
-            amount = int(data.get("amount", 0))
-            user_id = int(data.get("user_id", 0)) if data.get("user_id") else None
-            chat_id = int(data.get("chat_id", 0)) if data.get("chat_id") else None
-            hit_at_ts = int(data.get("hit_at_ts", 0))
-            keyword = data.get("keyword")
-            chat_title_raw = str(data.get("chat_title_raw") or "")
-
-            username_html = escape_html(self._normalize_username(username_raw))
-            chat_title_html = escape_html(chat_title_raw)
-            hit_dt = datetime.fromtimestamp(hit_at_ts, tz=self.tzinfo)
-            ts_str = hit_dt.strftime("%Y-%m-%d %H:%M:%S")
-
-            await self.bot.send_message(chat_id=self.target_chat_id, text=f"⏰ 时间：{ts_str}", parse_mode="HTML")
-            formatted_amount = format_amount_with_thousands(amount)
-            trigger_text = escape_html(f"{str(keyword or '')} {formatted_amount} ({amount})")
-            card = (
-                "🔔 新消息通知\n\n"
-                f"👤 目标用户：{username_html}\n"
-                f"🆔 用户 ID：{user_id}\n"
-                f"💬 触发消息：{trigger_text}\n"
-                f"👥 所在群组：{chat_title_html}（{chat_id}）\n"
-                f"🕒 时间：{ts_str}"
-            )
-            await self.bot.send_message(chat_id=self.target_chat_id, text=card, parse_mode="HTML")
-
-            # 入库
-            await self.db.insert_hit(
-                {
-                    "username": username_html,
-                    "user_id": user_id,
-                    "keyword": keyword,
-                    "amount": amount,
-                    "chat_id": chat_id,
-                    "chat_title": chat_title_html,
-                    "hit_at": hit_dt.replace(tzinfo=None),
-                }
-            )
+    async def _forward_one(self, entry_id: Optional[str], data: Dict[str, Any]) -> None:
+        from .filters import escape_html
+        ack = functools.partial(self.queue.ack, entry_id)
+        username_raw = str(data.get("username_raw") or "")
+        uname = self._normalize_username(username_raw).lstrip("@").lower()
+        if uname.endswith("bot") or uname.endswith("_bot") or ("bot" in uname):
+            await ack()
+            return
 
-    async def cleanup_old_keys(self) -> None:
-        # 兜底清理：删除 finalize_at 超过 1 天的过期键
-        now = int(time.time())
-        pattern = AGG_PREFIX + "*"
-        async for key in self.redis.client.scan_iter(match=pattern, count=1000):
-            data = await self.redis.client.hgetall(key)
-            if not data:
-                await self.redis.client.delete(key)
-                continue
-            finalize_at = int(data.get("finalize_at", 0))
-            if finalize_at and now - finalize_at > 86400:
-                await self.redis.client.delete(key)
+        # 10 分钟唯一：SET NX EX；值记录条目 ID，以识别同一条目的重新投递
+        last_key = LAST_SENT_PREFIX + self._normalize_username(username_raw)
+        ok = await self.redis.client.set(last_key, f"{int(time.time())}:{entry_id or ''}", ex=600, nx=True)
+        if not ok:
+            owner = str(await self.redis.client.get(last_key) or "").partition(":")[2]
+            if entry_id is None or owner != entry_id:
+                await ack()
+                return
+            # 已发送但未确认落库的条目被重新投递：不再重复发送，仅补写入库
+
+        amount = int(data.get("amount", 0))
+        user_id = int(data.get("user_id", 0)) if data.get("user_id") else None
+        chat_id = int(data.get("chat_id", 0)) if data.get("chat_id") else None
+        hit_at_ts = int(data.get("hit_at_ts", 0))
+        keyword = data.get("keyword")
+        chat_title_raw = str(data.get("chat_title_raw") or "")
+
+        username_html = escape_html(self._normalize_username(username_raw))
+        chat_title_html = escape_html(chat_title_raw)
+        hit_dt = datetime.fromtimestamp(hit_at_ts, tz=self.tzinfo)
+        ts_str = hit_dt.strftime("%Y-%m-%d %H:%M:%S")
+
+        if ok:
+            try:
+                sent_now = await self._send_alert(ts_str, username_html, user_id, keyword, amount, chat_title_html, chat_id)
+                enqueued_ts = data.get("enqueued_ts")
+                if sent_now and enqueued_ts:
+                    self._latencies_ms.append((time.time() - float(enqueued_ts)) * 1000)
+            except BaseException:
+                # 发送失败或被取消时释放去重键，便于条目被重新投递后再次发送
+                await self.redis.client.delete(last_key)
+                raise
+
+        # 入库
+        hit = {
+            "username": username_html,
+            "user_id": user_id,
+            "keyword": keyword,
+            "amount": amount,
+            "chat_id": chat_id,
+            "chat_title": chat_title_html,
+            "hit_at": hit_dt.replace(tzinfo=None),
+        }
+        if self.hit_writer is not None:
+            # 写后缓冲：所在批次落库后才确认条目；以条目 ID 去重，未落库期间被重新接管的条目不会重复入缓冲
+            await self.hit_writer.add(hit, on_persisted=ack, key=entry_id)
+        else:
+            await self.db.insert_hit(hit)
+            await ack()
+
+    def _build_card(
+        self,
+        ts_str: str,
+        username_html: str,
+        user_id: Optional[int],
+        keyword: Optional[str],
+        amount: int,
+        chat_title_html: str,
+        chat_id: Optional[int],
+    ) -> str:
+        from .filters import escape_html, format_amount_with_thousands
+        formatted_amount = format_amount_with_thousands(amount)
+        trigger_text = escape_html(f"{str(keyword or '')} {formatted_amount} ({amount})")
+        return (
+            "🔔 新消息通知\n\n"
+            f"👤 目标用户：{username_html}\n"
+            f"🆔 用户 ID：{user_id}\n"
+            f"💬 触发消息：{trigger_text}\n"
+            f"👥 所在群组：{chat_title_html}（{chat_id}）\n"
+            f"🕒 时间：{ts_str}"
+        )
 
+    async def _send_alert(
+        self,
+        ts_str: str,
+        username_html: str,
+        user_id: Optional[int],
+        keyword: Optional[str],
+        amount: int,
+        chat_title_html: str,
+        chat_id: Optional[int],
+    ) -> bool:
+        """发送告警卡片；返回 False 表示卡片已进入摘要缓冲，稍后合并发送。"""
+        priority = PRIORITY_HIGH if amount >= self.priority_amount else PRIORITY_NORMAL
+        card = self._build_card(ts_str, username_html, user_id, keyword, amount, chat_title_html, chat_id)
+        if self.card_mode == CARD_MODE_SPLIT:
+            # 兼容旧版：先单独发送时间，再发送卡片
+            await self.dispatcher.send(self.target_chat_id, f"⏰ 时间：{ts_str}", priority=priority, parse_mode="HTML")
+        elif priority != PRIORITY_HIGH and await self._digest_active():
+            self._digest_pending = int(await self.redis.client.rpush(self.digest_key, card))
+            return False
+        await self.dispatcher.send(self.target_chat_id, card, priority=priority, parse_mode="HTML")
+        return True
 
+    async def _digest_active(self) -> bool:
+        # 仅在积压较深时启用摘要合并，平时仍逐条即时发送；已有待合并卡片时继续合并以保持顺序
+        if self.digest_interval <= 0:
+            return False
+        backlog = sum(self._backlogs.values()) + self.dispatcher.stats()["queued"]
+        if backlog >= self.digest_threshold:
+            return True
+        self._digest_pending = int(await self.redis.client.llen(self.digest_key))
+        return self._digest_pending > 0
+
+    async def flush_digest(self) -> None:
+        """将待合并的卡片合并为尽量少的消息发送（单条消息不超过 Telegram 4096 字符上限），每条发送成功后才从列表移除。"""
+        async with self._digest_lock:
+            cards: List[str] = await self.redis.client.lrange(self.digest_key, 0, -1)
+            if not cards:
+                self._digest_pending = 0
+                return
+            # (消息文本, 包含的卡片数)
+            chunks: List[Tuple[str, int]] = []
+            current, n = "", 0
+            for card in cards:
+                candidate = f"{current}\n\n{DIGEST_SEPARATOR}\n\n{card}" if current else card
+                if len(candidate) > DIGEST_MAX_CHARS and current:
+                    chunks.append((current, n))
+                    current, n = card, 1
+                else:
+                    current, n = candidate, n + 1
+            if current:
+                chunks.append((current, n))
+            sent_cards = 0
+            for chunk, n in chunks:
+                try:
+                    await self.dispatcher.send(self.target_chat_id, chunk, parse_mode="HTML")
+                except Exception as e:
+                    # 未发送的卡片留在列表中，下次继续
+                    logger.exception("摘要发送失败：%s", e)
+                    break
+                # 列表头部即已发送的卡片；期间新追加的卡片在尾部，不受影响
+                await self.redis.client.ltrim(self.digest_key, n, -1)
+                sent_cards += n
+            self._digest_pending = int(await self.redis.client.llen(self.digest_key))
+            self.digest_flushes += 1
+            logger.info("摘要已发送：%s/%s 张卡片", sent_cards, len(cards))
+
+    async def cleanup_old_keys(self) -> None:
+        # 兜底清理：基于到期索引删除 finalize_at 超过 1 天仍未领取的键
+        cutoff = int(time.time()) - 86400
+        stale = await self.redis.client.zrangebyscore(AGG_DUE_KEY, "-inf", cutoff)
+        if not stale:
+            return
+        await self.redis.client.delete(*stale)
+        await self.redis.client.zremrangebyscore(AGG_DUE_KEY, "-inf", cutoff)
+        logger.info("清理过期聚合键：%s 条", len(stale))
@@ -0,0 +1,144 @@
+"""
+按群统计去重触发用户数的 Redis HyperLogLog 计数器。
+
+每个群维护一个全量 HLL（wd:hll:chat:<chat_id>）和按自然日的 HLL（wd:hll:chat:<chat_id>:d:<YYYYMMDD>），
+命中落库后 PFADD 规范化用户名（username_lc，排除机器人）。读取时：
+- 不限时间：对全量 HLL 做 PFCOUNT；
+- 指定时间范围：以天为粒度 PFMERGE 区间内的日 HLL 到临时键（短暂缓存）后 PFCOUNT。
+
+误差：Redis HLL 使用 16384 个寄存器，标准误差约 0.81%；即约 68% 的结果误差在 ±0.81% 内、
+约 95% 在 ±1.63% 内、约 99.7% 在 ±2.44% 内。基数较小时（几百以内）Redis 使用稀疏表示，
+结果通常是精确的。需要精确值时使用 exact 模式回退到 SQL。
+"""
+
+from __future__ import annotations
+
+import logging
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+
+logger = logging.getLogger(__name__)
+
+
+HLL_PREFIX = "wd:hll:"
+HLL_CHATS_KEY = f"{HLL_PREFIX}chats"
+# 时间范围合并结果的缓存时长
+HLL_MERGED_TTL = 60
+# 重建完成标记：只由 rebuild() 写入，实时 PFADD 不会创建
+HLL_BUILT_KEY = f"{HLL_PREFIX}built"
+
+
+def chat_key(chat_id: int) -> str:
+    return f"{HLL_PREFIX}chat:{chat_id}"
+
+
+def chat_day_key(chat_id: int, day: date) -> str:
+    return f"{HLL_PREFIX}chat:{chat_id}:d:{day:%Y%m%d}"
+
+
+def _days(start: date, end: date) -> List[date]:
+    return [start + timedelta(days=i) for i in range((end - start).days + 1)]
+
+
+class UniqueUserCounter:
+    def __init__(self, redis_client, tzinfo: Any, day_retention_days: int = 400) -> None:
+        self.redis = redis_client
+        self.tzinfo = tzinfo
+        self.day_ttl = day_retention_days * 86400
+
+    def _today(self) -> date:
+        return datetime.now(self.tzinfo).date()
+
+    async def record(self, rows: Iterable[Dict[str, Any]]) -> None:
+        """累加一批命中（字段同 hits 行：chat_id/username_lc/is_bot/hit_at）。"""
+        members: Dict[str, Set[str]] = defaultdict(set)
+        day_keys: Set[str] = set()
+        chats: Set[int] = set()
+        for r in rows:
+            chat_id = r.get("chat_id")
+            username = r.get("username_lc")
+            if not chat_id or not username or r.get("is_bot"):
+                continue
+            chats.add(int(chat_id))
+            members[chat_key(chat_id)].add(username)
+            dk = chat_day_key(chat_id, r["hit_at"].date())
+            members[dk].add(username)
+            day_keys.add(dk)
+        if not members:
+            return
+        pipe = self.redis.client.pipeline(transaction=False)
+        for key, names in members.items():
+            pipe.pfadd(key, *names)
+        for key in day_keys:
+            pipe.expire(key, self.day_ttl)
+        pipe.sadd(HLL_CHATS_KEY, *chats)
+        await pipe.execute()
+
+    async def available(self) -> bool:
+        """执行过重建才认为计数器可用（首次上线需先执行 --rebuild-hll），否则只有上线后的增量数据。"""
+        return bool(await self.redis.client.exists(HLL_BUILT_KEY))
+
+    async def chat_ids(self) -> List[int]:
+        return [int(c) for c in await self.redis.client.smembers(HLL_CHATS_KEY)]
+
+    async def counts(
+        self,
+        chat_ids: List[int],
+        start_time: Optional[datetime] = None,
+        end_time: Optional[datetime] = None,
+    ) -> Dict[int, int]:
+        """返回 {chat_id: 估算去重用户数}。指定时间范围时按天取整（含首尾两天）。"""
+        client = self.redis.client
+        pipe = client.pipeline(transaction=False)
+        if start_time is None and end_time is None:
+            for cid in chat_ids:
+                pipe.pfcount(chat_key(cid))
+            return {cid: int(n or 0) for cid, n in zip(chat_ids, await pipe.execute())}
+
+        end = (end_time.date() if end_time else self._today())
+        start = start_time.date() if start_time else end - timedelta(seconds=self.day_ttl)
+        days = _days(start, end) if start <= end else []
+        if not days:
+            return {cid: 0 for cid in chat_ids}
+        for cid in chat_ids:
+            dest = f"{HLL_PREFIX}tmp:{cid}:{start:%Y%m%d}-{end:%Y%m%d}"
+            pipe.pfmerge(dest, *[chat_day_key(cid, d) for d in days])
+            pipe.expire(dest, HLL_MERGED_TTL)
+            pipe.pfcount(dest)
+        results = await pipe.execute()
+        return {cid: int(results[i * 3 + 2] or 0) for i, cid in enumerate(chat_ids)}
+
+    async def clear(self) -> int:
+        client = self.redis.client
+        removed = 0
+        batch: List[str] = []
+        async for key in client.scan_iter(match=f"{HLL_PREFIX}*", count=1000):
+            batch.append(key)
+            if len(batch) >= 500:
+                removed += await client.delete(*batch)
+                batch = []
+        if batch:
+            removed += await client.delete(*batch)
+        return removed
+
+    async def rebuild(self, db) -> int:
+        """清空后从 hits 全量重建（逐块读取去重的 (群, 日, 用户)），返回处理的行数。"""
+        await self.clear()
+        cutoff = self._today() - timedelta(seconds=self.day_ttl)
+        total = 0
+        async for chunk in db.stream_chat_day_users():
+            rows = [
+                {"chat_id": cid, "username_lc": username, "is_bot": False, "hit_at": day}
+                for cid, day, username in chunk
+            ]
+            await self.record(rows)
+            # 超出保留期的日 HLL 无需保留（全量 HLL 已计入）
+            stale = {chat_day_key(r["chat_id"], r["hit_at"].date()) for r in rows if r["hit_at"].date() < cutoff}
+            if stale:
+                await self.redis.client.delete(*stale)
+            total += len(rows)
+        await self.redis.client.set(HLL_BUILT_KEY, int(datetime.now(self.tzinfo).timestamp()))
+        logger.info("去重用户 HLL 已从 hits 重建：%s 行", total)
+        return total